@@ -0,0 +1,65 @@
+'''
+Purpose: Show that the DarkMatter database join in labeler scales linearly with the number of rows
+
+Use case (from the repository root, so chemidr is importable):
+    PYTHONPATH=. python benchmarks/bench_darkmatter.py --db-size 20000
+'''
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from chemidr.labeler import __build_darkmatter_lookup__, __darkmatter_database__
+
+
+def make_dmdb(size):
+    ids = np.arange(size)
+    return pd.DataFrame({
+        'name' : [f'Chem {i}' for i in ids],
+        'USDA' : [f'usda chem {i}' for i in ids],
+        'Pubchem' : (ids + 1).astype(str),
+        'start' : [f'KEY{i:010d}' for i in ids],
+        'FooDB ID' : (ids + 1).astype(str),
+    })
+
+
+def make_frame(rows, db_size, rng):
+    # Half name hits, a quarter USDA hits and a quarter misses
+    draws = rng.integers(0, db_size, rows)
+    kind = rng.integers(0, 4, rows)
+    chems = np.where(kind < 2, 'chem ', np.where(kind == 2, 'usda chem ', 'missing ')).astype(object) + draws.astype(str)
+
+    return pd.DataFrame({
+        'chem' : chems,
+        'pubchem_id' : pd.Series(np.where(rng.random(rows) < .5, np.nan, 1.), dtype=object),
+        'foodb_id' : np.where(rng.random(rows) < .5, np.nan, 1.),
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-size', dest='db_size', type=int, default=20000, help='rows in the synthetic DarkMatter database')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='timing repetitions per size')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    start = time.perf_counter()
+    lookup = __build_darkmatter_lookup__(make_dmdb(args.db_size))
+    print(f'Built lookup over {args.db_size} entries in {time.perf_counter() - start:.3f} s')
+
+    print(f'{"rows":>10} {"seconds":>10} {"us / row":>10}')
+    for rows in [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]:
+        df = make_frame(rows, args.db_size, rng)
+
+        times = []
+        for _ in range(args.repeat):
+            frame = df.copy()
+            start = time.perf_counter()
+            __darkmatter_database__(frame, 'chem', lookup=lookup)
+            times.append(time.perf_counter() - start)
+
+        best = min(times)
+        print(f'{rows:>10} {best:>10.4f} {best / rows * 1e6:>10.3f}')
@@ -0,0 +1,55 @@
+'''
+Purpose: Compare labeler.normalize_terms with the per-string cleaning functions it replaces, and check that
+both produce identical variants
+
+Use case (from the repository root, so chemidr is importable):
+    PYTHONPATH=. python benchmarks/bench_normalize.py --size 200000
+'''
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from chemidr.labeler import normalize_terms, __is_nutrient__, __clean_term__, __clean_compound_name__
+
+
+PIECES = ['allyl', 'di', 'sulfide', '(+)-', 'cis-', ' trans ', 'l-', '*alpha*', '-*beta*-', 'carotene', ' acid',
+          'methyl', ' ', '  ', '-', 's', 'fat', 'Protein', 'α', '2-', 'ol', 'N ']
+
+
+def make_terms(size, rng):
+    counts = rng.integers(1, 7, size)
+    return pd.Series([''.join(rng.choice(PIECES, c)) for c in counts])
+
+
+def per_string(terms):
+    return pd.DataFrame({
+        'is_nutrient' : [__is_nutrient__(t) for t in terms],
+        'url' : [__clean_term__(t, convert_letter=False) for t in terms],
+        'no_space' : [__clean_term__(t, convert_letter=False, w_space=False) for t in terms],
+        'compound_url' : [__clean_term__(__clean_compound_name__(t), convert_letter=False) for t in terms],
+    }, index=terms.index)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', dest='size', type=int, default=200000, help='number of chemical strings')
+    args = parser.parse_args()
+
+    terms = make_terms(args.size, np.random.default_rng(0))
+
+    start = time.perf_counter()
+    expected = per_string(terms)
+    serial_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    variants = normalize_terms(terms)
+    batch_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(variants.astype(object), expected.astype(object))
+
+    print(f'{args.size} strings, outputs identical')
+    print(f'per-string : {serial_time:.3f} s')
+    print(f'batch      : {batch_time:.3f} s ({serial_time / batch_time:.1f}x)')
@@ -0,0 +1,105 @@
+"""
+    Purpose: Persistent SQLite cache for chemical string resolutions, so reruns over the same vocabulary
+    don't have to query PubChem again
+
+    Entries are keyed by the cleaned term and the resolution tier that produced them. Misses are stored as
+    well as hits (with a NULL cid), and every entry carries its own expiry time
+
+    Example Usage:
+        cache = ResolutionCache('intermediate_save/pubchem_cache.sqlite', ttl=30)
+        cache.set('allicin', 'exact', 65036., 'Allicin')
+        cache.get('allicin', 'exact') # (65036.0, 'Allicin')
+"""
+
+import numpy as np
+import sqlite3
+import threading
+import time
+
+
+__SECONDS_PER_DAY__ = 24 * 60 * 60
+
+
+class ResolutionCache:
+    """
+        Input
+        ----------------------------------------------------------------
+        path : str
+            location of the sqlite database, created if it does not exist
+        ttl : float or None (default 30)
+            days before a hit expires, never expires if None
+        miss_ttl : float or None (default 7)
+            days before a miss expires, never expires if None. Kept shorter than ttl since new
+            synonyms are added to PubChem over time
+    """
+    def __init__(self, path, ttl=30, miss_ttl=7):
+        self.path = path
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+
+        # Connection is shared by the resolution worker threads, so access is serialized with a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            '''CREATE TABLE IF NOT EXISTS resolutions (
+                term TEXT NOT NULL,
+                tier TEXT NOT NULL,
+                cid REAL,
+                name TEXT,
+                expires REAL,
+                PRIMARY KEY (term, tier)
+            )'''
+        )
+
+    def get(self, term, tier):
+        """
+            Returns the cached (cid, name) for a term and tier, (np.nan, np.nan) for a cached miss, or
+            None if the term has not been resolved or the entry has expired
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT cid, name, expires FROM resolutions WHERE term = ? AND tier = ?', (term, tier)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        cid, name, expires = row
+
+        if expires is not None and expires < time.time():
+            return None
+
+        if cid is None:
+            return np.nan, np.nan
+
+        return cid, name
+
+    def set(self, term, tier, cid, name):
+        """
+            Stores the result of resolving a term with a tier, a nan cid is stored as a miss
+        """
+        is_miss = cid is None or (isinstance(cid, float) and np.isnan(cid))
+
+        ttl = self.miss_ttl if is_miss else self.ttl
+        expires = None if ttl is None else time.time() + ttl * __SECONDS_PER_DAY__
+
+        if is_miss:
+            cid, name = None, None
+
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO resolutions (term, tier, cid, name, expires) VALUES (?, ?, ?, ?, ?)',
+                (term, tier, cid, name, expires)
+            )
+
+    def purge_expired(self):
+        """
+            Deletes expired entries from the database
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM resolutions WHERE expires < ?', (time.time(),))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
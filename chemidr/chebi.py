@@ -0,0 +1,296 @@
+"""
+    Purpose: Local store of the ChEBI hierarchy of PubChem compounds, so lineages and "all compounds under a
+    class" queries are answered from disk instead of downloading the classification of every compound again
+
+    Every ChEBI node is saved once (id and name) together with its parent edges, and shared by all compounds
+    that fall under it. After new compounds are added the ancestor closure (every node paired with each of
+    its ancestors and their distance) is recomputed, so both directions of the hierarchy are a single
+    indexed lookup
+
+    Example Usage:
+        store = ChEBIStore('intermediate_save/chebi.sqlite')
+        fetch_hierarchies([65036, 5280343], store, workers=4)
+        store.lineage([65036])
+        store.compounds_under(33709) # cids of all stored amino acids
+"""
+
+import json
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from .transport import safe_urlopen
+
+
+__CHEBI_ID__ = re.compile(r'CHEBI:(\d+)')
+
+
+def classification_url(cid):
+    return f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{int(cid)}/classification/JSON'
+
+
+def parse_hierarchy(content, taxonomy='ChEBI'):
+    """
+        Extracts one source's hierarchy from a PubChem classification response
+
+        Input
+        ----------------------------------------------------------------
+        content : bytes or str
+            classification JSON of a compound
+        taxonomy : str (default 'ChEBI')
+            SourceName of the hierarchy
+
+        Returns
+        ----------------------------------------------------------------
+        nodes : list or None
+            one dict per node with its 'node' id, 'chebi_id' (None for nodes without one, e.g. the root),
+            'name' and 'parents' (node ids), in the order of the response. None if the source is missing
+    """
+    hierarchies = json.loads(content)['Hierarchies']['Hierarchy']
+    raw_tax = next((h for h in hierarchies if h['SourceName'] == taxonomy), None)
+
+    if raw_tax is None:
+        return None
+
+    nodes = []
+    for node in raw_tax['Node']:
+        info = node['Information']
+        match = __CHEBI_ID__.search(info.get('URL', ''))
+
+        nodes.append({
+            'node' : node['NodeID'],
+            'chebi_id' : int(match.group(1)) if match else None,
+            'name' : info['Name'],
+            'parents' : node.get('ParentID', []),
+        })
+
+    return nodes
+
+
+def fetch_hierarchy(cid, taxonomy='ChEBI'):
+    """
+        Downloads and parses the hierarchy of a cid (see parse_hierarchy), None if the cid or the source
+        does not exist
+    """
+    r = safe_urlopen(classification_url(cid))
+
+    if r is None:
+        return None
+
+    return parse_hierarchy(r, taxonomy=taxonomy)
+
+
+class ChEBIStore:
+    """
+        Input
+        ----------------------------------------------------------------
+        path : str
+            location of the sqlite database, created if it does not exist
+    """
+    def __init__(self, path):
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(
+            '''CREATE TABLE IF NOT EXISTS nodes (
+                chebi_id INTEGER PRIMARY KEY,
+                name TEXT
+            );
+            CREATE TABLE IF NOT EXISTS edges (
+                child INTEGER NOT NULL,
+                parent INTEGER NOT NULL,
+                PRIMARY KEY (child, parent)
+            );
+            CREATE TABLE IF NOT EXISTS compounds (
+                cid INTEGER NOT NULL,
+                chebi_id INTEGER NOT NULL,
+                PRIMARY KEY (cid, chebi_id)
+            );
+            CREATE INDEX IF NOT EXISTS compounds_chebi ON compounds (chebi_id);
+            CREATE TABLE IF NOT EXISTS fetched (
+                cid INTEGER PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS closure (
+                descendant INTEGER NOT NULL,
+                ancestor INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                PRIMARY KEY (descendant, ancestor)
+            );
+            CREATE INDEX IF NOT EXISTS closure_ancestor ON closure (ancestor);
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            );
+            INSERT OR IGNORE INTO state VALUES ('closure_stale', 0);'''
+        )
+        self._conn.commit()
+
+    def missing(self, cids):
+        """
+            Returns the cids whose hierarchy has not been stored yet, in the order of cids
+        """
+        with self._lock:
+            done = {r[0] for r in self._conn.execute('SELECT cid FROM fetched')}
+
+        return [int(cid) for cid in dict.fromkeys(int(c) for c in cids) if cid not in done]
+
+    def add(self, cid, nodes):
+        """
+            Stores the hierarchy of a cid, as returned by parse_hierarchy. A cid without a hierarchy (None)
+            is recorded so it is not fetched again. The closure is marked stale (in the database, so it survives
+            a crash) until update_closure is called, which queries do when needed
+        """
+        cid = int(cid)
+        nodes = nodes or []
+        by_node = {n['node'] : n['chebi_id'] for n in nodes}
+
+        # The compound's own entries are the nodes that are not the parent of any other node
+        parents = {p for n in nodes for p in n['parents']}
+        leaves = [n['chebi_id'] for n in nodes if n['node'] not in parents and n['chebi_id'] is not None]
+
+        edges = [
+            (n['chebi_id'], by_node[p]) for n in nodes for p in n['parents']
+            if n['chebi_id'] is not None and by_node.get(p) is not None
+        ]
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO nodes VALUES (?, ?)',
+                [(n['chebi_id'], n['name']) for n in nodes if n['chebi_id'] is not None]
+            )
+            self._conn.executemany('INSERT OR IGNORE INTO edges VALUES (?, ?)', edges)
+            self._conn.executemany('INSERT OR IGNORE INTO compounds VALUES (?, ?)', [(cid, c) for c in leaves])
+            self._conn.execute('INSERT OR IGNORE INTO fetched VALUES (?)', (cid,))
+            self._conn.execute("UPDATE state SET value = 1 WHERE key = 'closure_stale'")
+
+    def update_closure(self):
+        """
+            Recomputes the ancestor closure from the stored edges, keeping the shortest distance of every
+            (descendant, ancestor) pair. Every node is its own ancestor at depth 0
+        """
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM closure')
+            self._conn.execute(
+                '''INSERT INTO closure
+                WITH RECURSIVE anc(descendant, ancestor, depth) AS (
+                    SELECT chebi_id, chebi_id, 0 FROM nodes
+                    UNION
+                    SELECT anc.descendant, edges.parent, anc.depth + 1
+                    FROM anc JOIN edges ON edges.child = anc.ancestor
+                )
+                SELECT descendant, ancestor, MIN(depth) FROM anc GROUP BY descendant, ancestor'''
+            )
+            self._conn.execute("UPDATE state SET value = 0 WHERE key = 'closure_stale'")
+
+    def closure_stale(self):
+        """
+            True if hierarchies were added after the closure was last computed
+        """
+        with self._lock:
+            return bool(self._conn.execute("SELECT value FROM state WHERE key = 'closure_stale'").fetchone()[0])
+
+    # Recomputes the closure if compounds were added since, e.g. by a run that stopped before updating it
+    def __ensure_closure__(self):
+        if self.closure_stale():
+            self.update_closure()
+
+    # Runs a query with an "IN ({})" placeholder for ids, in sorted chunks that stay under sqlite's
+    # variable limit
+    def __query_in__(self, sql, ids, chunk_size=900):
+        self.__ensure_closure__()
+        ids = sorted(set(ids))
+        rows = []
+
+        with self._lock:
+            for start in range(0, len(ids), chunk_size):
+                chunk = ids[start : start + chunk_size]
+                rows.extend(self._conn.execute(sql.format(','.join('?' * len(chunk))), chunk).fetchall())
+
+        return rows
+
+    def ancestors(self, chebi_ids):
+        """
+            Returns a pd.DataFrame of ('chebi_id', 'ancestor', 'name', 'depth') with every stored ancestor of
+            chebi_ids (including the node itself at depth 0), ordered by chebi_id and depth
+        """
+        rows = self.__query_in__(
+            '''SELECT c.descendant, c.ancestor, n.name, c.depth FROM closure c JOIN nodes n ON n.chebi_id = c.ancestor
+            WHERE c.descendant IN ({}) ORDER BY c.descendant, c.depth, c.ancestor''',
+            [int(c) for c in chebi_ids]
+        )
+
+        return pd.DataFrame(rows, columns=['chebi_id', 'ancestor', 'name', 'depth'])
+
+    def lineage(self, cids):
+        """
+            Returns a pd.DataFrame of ('cid', 'chebi_id', 'name', 'depth') with every ChEBI class each cid
+            falls under, depth being the distance from the compound's own entry. Ordered by cid and depth
+        """
+        rows = self.__query_in__(
+            '''SELECT m.cid, c.ancestor, n.name, MIN(c.depth) FROM compounds m
+            JOIN closure c ON c.descendant = m.chebi_id JOIN nodes n ON n.chebi_id = c.ancestor
+            WHERE m.cid IN ({}) GROUP BY m.cid, c.ancestor
+            ORDER BY m.cid, MIN(c.depth), c.ancestor''',
+            [int(c) for c in cids]
+        )
+
+        return pd.DataFrame(rows, columns=['cid', 'chebi_id', 'name', 'depth'])
+
+    def compounds_under(self, chebi_id):
+        """
+            Returns the sorted cids of all stored compounds that fall under chebi_id
+        """
+        self.__ensure_closure__()
+
+        with self._lock:
+            rows = self._conn.execute(
+                '''SELECT DISTINCT m.cid FROM closure c JOIN compounds m ON m.chebi_id = c.descendant
+                WHERE c.ancestor = ? ORDER BY m.cid''',
+                (int(chebi_id),)
+            ).fetchall()
+
+        return [r[0] for r in rows]
+
+    def close(self):
+        self._conn.close()
+
+
+def fetch_hierarchies(cids, store, workers=4):
+    """
+        Adds the ChEBI hierarchies of cids to a store. Only cids that are not in the store yet are downloaded
+        (workers at a time, paced by the PubChem rate limit), and the closure is updated once at the end, also
+        when a request fails
+
+        Input
+        ----------------------------------------------------------------
+        cids : list
+            pubchem cids
+        store : ChEBIStore
+            store to add the hierarchies to
+        workers : int (default 4)
+            number of classifications requested at once
+
+        Returns
+        ----------------------------------------------------------------
+        lineage : pd.DataFrame
+            store.lineage(cids)
+    """
+    cids = list(cids)
+    missing = store.missing(cids)
+
+    # Compounds stored before a failed request still get their closure, and the failed ones stay missing
+    try:
+        if len(missing) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                for cid, nodes in zip(missing, pool.map(fetch_hierarchy, missing)):
+                    store.add(cid, nodes)
+    finally:
+        if store.closure_stale():
+            store.update_closure()
+
+    return store.lineage(cids)
@@ -1,55 +1,278 @@
 import pandas as pd
 import numpy as np
+import os
+import tempfile
+import time
+from functools import partial, lru_cache
+from multiprocessing import Pool
+from scipy import sparse
 
 from rdkit import Chem
-from rdkit.Chem import AllChem
 from rdkit.Chem import DataStructs
+from rdkit.Chem import rdFingerprintGenerator
+from gensim.models import Word2Vec, KeyedVectors
 
 
 # Convert SMILE's to chemical fingerprints
 def get_fingerprint_string(SMILE):
     # Gets dictionary of subcompountnets and their counts
-    sub_dict = AllChem.GetMorganFingerprint(Chem.MolFromSmiles(SMILE),1).GetNonzeroElements()
+    sub_dict = __morgan_counts__(Chem.MolFromSmiles(SMILE), 1)
 
+    return __counts_to_string__(sub_dict.keys(), sub_dict.values())
+
+
+# One generator per radius and process. Gives the same identifiers as AllChem.GetMorganFingerprint, without
+# its deprecation warning on every call
+@lru_cache(maxsize=None)
+def __morgan_generator__(radius):
+    return rdFingerprintGenerator.GetMorganGenerator(radius=radius)
+
+
+# Dictionary of Morgan identifiers and their counts
+def __morgan_counts__(mol, radius):
+    return __morgan_generator__(radius).GetSparseCountFingerprint(mol).GetNonzeroElements()
+
+
+# Sentence of identifiers, each repeated by its count
+def __counts_to_string__(keys, counts):
     fingerprint = []
-    for key, value in sub_dict.items():
-        fingerprint = fingerprint + [str(key)] * value
+    for key, value in zip(keys, counts):
+        fingerprint.extend([str(key)] * value)
 
     return ' '.join(fingerprint)
 
 
+# Fingerprint sentence, identifiers and counts of a SMILE from a single parse, None if it can not be parsed
+def __fingerprint_counts__(SMILE, radius=1):
+    mol = Chem.MolFromSmiles(SMILE) if isinstance(SMILE, str) else None
+
+    if mol is None:
+        return None
+
+    sub_dict = __morgan_counts__(mol, radius)
+
+    keys = np.fromiter(sub_dict.keys(), dtype=np.uint32, count=len(sub_dict))
+    counts = np.fromiter(sub_dict.values(), dtype=np.int32, count=len(sub_dict))
+
+    return __counts_to_string__(sub_dict.keys(), sub_dict.values()), keys, counts
+
+
+def batch_fingerprints(SMILES, radius=1, processes=None, chunksize=500):
+    """
+        Fingerprints many SMILES in a process pool. SMILES are streamed to the workers in chunks, so any
+        iterable (e.g. a generator over a large file) can be used
+
+        Input
+        ----------------------------------------------------------------
+        SMILES : iterable
+            SMILE strings
+        radius : int (default 1)
+            Morgan fingerprint radius
+        processes : int (default None)
+            number of worker processes, defaults to the number of cores. 1 runs in the calling process
+        chunksize : int (default 500)
+            SMILES sent to a worker at once
+
+        Returns
+        ----------------------------------------------------------------
+        fingerprints : pd.DataFrame
+            one row per SMILE with the 'fingerprint' sentence (as get_fingerprint_string, np.nan if the SMILE
+            could not be parsed) and 'failed'
+        counts : scipy.sparse.csr_matrix
+            identifier x molecule matrix of substructure counts, failed molecules are empty columns
+        identifiers : np.ndarray
+            sorted Morgan identifier of every row of counts
+    """
+    return __collect_fingerprints__(
+        __map_smiles__(partial(__fingerprint_counts__, radius=radius), SMILES, processes, chunksize)
+    )
+
+
+# Applies func to every SMILE in order, in a process pool unless processes is 1
+def __map_smiles__(func, SMILES, processes=None, chunksize=500):
+    if processes == 1:
+        yield from map(func, SMILES)
+        return
+
+    with Pool(processes) as pool:
+        yield from pool.imap(func, SMILES, chunksize=chunksize)
+
+
+def __collect_fingerprints__(results):
+    sentences, failed, keys, counts, lengths = [], [], [], [], []
+
+    for result in results:
+        if result is None:
+            sentences.append(np.nan)
+            failed.append(True)
+            lengths.append(0)
+            continue
+
+        sentence, k, c = result
+        sentences.append(sentence)
+        failed.append(False)
+        keys.append(k)
+        counts.append(c)
+        lengths.append(len(k))
+
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.uint32)
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int32)
+    molecules = np.repeat(np.arange(len(lengths)), lengths)
+
+    identifiers, rows = np.unique(keys, return_inverse=True)
+
+    matrix = sparse.csr_matrix((counts, (rows, molecules)), shape=(len(identifiers), len(lengths)))
+
+    fingerprints = pd.DataFrame({'fingerprint' : pd.Series(sentences, dtype=object), 'failed' : np.array(failed, dtype=bool)})
+
+    return fingerprints, matrix, identifiers
+
+
 # Organize fingerprints into correct molecular order
 def get_ordered_fingerprint_string(SMILE):
-    bi = {}
-    AllChem.GetMorganFingerprint(Chem.MolFromSmiles(SMILE), radius=1, bitInfo=bi)
+    return __ordered_fingerprint__(Chem.MolFromSmiles(SMILE), 1)
 
-    mol = pd.DataFrame()
-    for key, value in bi.items():
-        for i in range(len(value)):
-            sub = pd.Series()
-            sub['val'] = str(key)
 
-            sub['order'] = value[i][0]
-            sub['radius'] = value[i][1]
+# Identifiers of every atom environment ordered by atom, then radius. Collected into flat arrays and ordered
+# with a single lexsort
+def __ordered_fingerprint__(mol, radius):
+    output = rdFingerprintGenerator.AdditionalOutput()
+    output.AllocateBitInfoMap()
+    __morgan_generator__(radius).GetSparseCountFingerprint(mol, additionalOutput=output)
 
-            mol = mol.append(sub, ignore_index=True)
+    bi = output.GetBitInfoMap()
+    size = sum(len(envs) for envs in bi.values())
 
-    mol = mol.sort_values(by=['order', 'radius']).reset_index(drop=True)
-    #display(mol)
-    
-    mol_string = " ".join(mol.val.tolist())
-        
-    return mol_string.strip()
+    keys = np.empty(size, dtype=np.uint32)
+    atoms = np.empty(size, dtype=np.int32)
+    radii = np.empty(size, dtype=np.int32)
+
+    i = 0
+    for key, envs in bi.items():
+        for atom, r in envs:
+            keys[i], atoms[i], radii[i] = key, atom, r
+            i += 1
+
+    return ' '.join(keys[np.lexsort((radii, atoms))].astype(str))
+
+
+def __ordered_fingerprint_smile__(SMILE, radius=1):
+    mol = Chem.MolFromSmiles(SMILE) if isinstance(SMILE, str) else None
+
+    return None if mol is None else __ordered_fingerprint__(mol, radius)
+
+
+def batch_ordered_fingerprints(SMILES, radius=1, processes=None, chunksize=500):
+    """
+        Ordered fingerprint sentences (as get_ordered_fingerprint_string) of many SMILES, computed in a
+        process pool (see batch_fingerprints)
+
+        Returns
+        ----------------------------------------------------------------
+        fingerprints : pd.DataFrame
+            one row per SMILE with the ordered 'fingerprint' sentence (np.nan if the SMILE could not be
+            parsed) and 'failed'
+    """
+    sentences = list(__map_smiles__(partial(__ordered_fingerprint_smile__, radius=radius), SMILES, processes, chunksize))
+    failed = np.array([sentence is None for sentence in sentences], dtype=bool)
+
+    return pd.DataFrame({
+        'fingerprint' : pd.Series([np.nan if f else sentence for sentence, f in zip(sentences, failed)], dtype=object),
+        'failed' : failed,
+    })
 
 
 # def UNK_replacement(string):
 
 
-def train_mol2vec(fingerprints, dim_embedding=100):
-	fingerprints = [f.split() for f in chems.fingerprint.tolist()]
+def write_corpus(fingerprints, corpus_fp):
+    """
+        Writes fingerprint sentences to a corpus file, one sentence per line, skipping missing sentences
+
+        Returns
+        ----------------------------------------------------------------
+        count : int
+            number of sentences written
+    """
+    count = 0
+
+    with open(corpus_fp, 'w') as f:
+        for fingerprint in fingerprints:
+            if isinstance(fingerprint, str) and fingerprint.strip() != '':
+                f.write(fingerprint.strip() + '\n')
+                count += 1
+
+    return count
+
+
+def train_mol2vec(fingerprints, dim_embedding=100, window=5, min_count=1, epochs=5, workers=None, save_fp=None):
+    """
+        Trains skip-gram substructure embeddings. Training streams the sentences from a corpus file with gensim's
+        corpus_file mode, so the corpus is never held in memory as split lists and every worker thread reads its
+        own part of the file
+
+        Input
+        ----------------------------------------------------------------
+        fingerprints : str or iterable
+            corpus file with one fingerprint sentence per line (see write_corpus), or an iterable of sentences
+            that is first written to a temporary corpus file
+        dim_embedding : int (default 100)
+            embedding dimension
+        window : int (default 5)
+            context window
+        min_count : int (default 1)
+            minimum number of occurrences of a substructure to be embedded
+        epochs : int (default 5)
+            passes over the corpus
+        workers : int (default None)
+            training threads, defaults to the number of cores
+        save_fp : str (default None)
+            saves the vectors there when given, reload them with load_mol2vec
+
+        Returns
+        ----------------------------------------------------------------
+        model : Word2Vec
+            trained model
+    """
+    workers = os.cpu_count() if workers is None else workers
+
+    if isinstance(fingerprints, str):
+        return __train_corpus__(fingerprints, dim_embedding, window, min_count, epochs, workers, save_fp)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_fp = os.path.join(tmp, 'corpus.txt')
+        write_corpus(fingerprints, corpus_fp)
+
+        return __train_corpus__(corpus_fp, dim_embedding, window, min_count, epochs, workers, save_fp)
+
+
+def __train_corpus__(corpus_fp, dim_embedding, window, min_count, epochs, workers, save_fp):
+    model = Word2Vec(vector_size=dim_embedding, sg=1, window=window, min_count=min_count, epochs=epochs, workers=workers)
+    model.build_vocab(corpus_file=corpus_fp)
 
-	model = Word2Vec(fingerprints, size=dim_embedding, sg=1, window=5, min_count=1, workers=4)
-	model.train(fingerprints, total_examples=model.corpus_count, epochs=model.epochs)
+    start = time.time()
+    _, raw_words = model.train(
+        corpus_file=corpus_fp, total_examples=model.corpus_count, total_words=model.corpus_total_words,
+        epochs=model.epochs
+    )
+    elapsed = time.time() - start
+
+    print(f'Trained on {model.corpus_count} sentences ({raw_words} tokens) in {elapsed / 60:.2f} min,',
+          f'{raw_words / max(elapsed, 1e-9):.0f} tokens / s on {workers} workers')
+
+    if save_fp is not None:
+        # Vectors are stored as a separate .npy file so they can be memory mapped on load
+        model.wv.save(save_fp, separately=['vectors'])
+
+    return model
+
+
+def load_mol2vec(fp, mmap='r'):
+    """
+        Loads vectors saved by train_mol2vec, memory mapped read-only by default so many processes share one
+        copy of the embedding matrix
+    """
+    return KeyedVectors.load(fp, mmap=mmap)
 
 
 def calc_fingerprint_vector(fingerprint, model=None):
@@ -61,4 +284,61 @@ def calc_fingerprint_vector(fingerprint, model=None):
     
     fingerprint_vector = ' '.join([str(i) for i in fingerprint_vector])
     
-    return fingerprint_vector
\ No newline at end of file
+    return fingerprint_vector
+
+def fingerprint_vectors(fingerprints, model, unknown='skip'):
+    """
+        Mean substructure embedding of many fingerprint sentences. Every distinct token is mapped to its
+        vocabulary index once, and the means are a single sparse (molecule x vocabulary) product with the
+        embedding matrix
+
+        Input
+        ----------------------------------------------------------------
+        fingerprints : iterable
+            fingerprint sentences (as get_fingerprint_string), np.nan for missing molecules
+        model : Word2Vec or KeyedVectors
+            trained substructure embeddings
+        unknown : str (default 'skip')
+            tokens missing from the vocabulary are left out of the mean ('skip'), averaged in as zero vectors
+            ('zero'), raise a KeyError ('error'), or are replaced by the vector of the given token (e.g. 'UNK')
+
+        Returns
+        ----------------------------------------------------------------
+        vectors : np.ndarray
+            C-contiguous float32 matrix with one row per sentence, rows of molecules without any tokens to
+            average (or missing sentences) are np.nan
+    """
+    wv = getattr(model, 'wv', model)
+    embeddings = np.asarray(wv.vectors, dtype=np.float32)
+
+    sentences = [f.split() if isinstance(f, str) else [] for f in fingerprints]
+    lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+    tokens = pd.Series([t for s in sentences for t in s], dtype=object)
+
+    codes, uniques = pd.factorize(tokens)
+    vocab_index = np.array([wv.key_to_index.get(t, -1) for t in uniques], dtype=np.int64)
+    index = vocab_index[codes] if len(codes) > 0 else np.zeros(0, dtype=np.int64)
+    molecules = np.repeat(np.arange(len(sentences)), lengths)
+
+    # Zero vectors still count towards the mean, so the counts are taken before unknown tokens are dropped
+    missing = index < 0
+    totals = np.bincount(molecules, minlength=len(sentences))
+
+    if missing.any():
+        if unknown == 'error':
+            raise KeyError(f'{missing.sum()} tokens are not in the vocabulary, e.g. {tokens[missing].iloc[0]}')
+        elif unknown in ('skip', 'zero'):
+            index, molecules = index[~missing], molecules[~missing]
+        else:
+            index = np.where(missing, wv.key_to_index[unknown], index)
+
+    counts = totals if unknown == 'zero' else np.bincount(molecules, minlength=len(sentences))
+
+    membership = sparse.csr_matrix(
+        (np.ones(len(index), dtype=np.float32), (molecules, index)), shape=(len(sentences), len(embeddings))
+    )
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vectors = (membership @ embeddings) / counts[:, None].astype(np.float32)
+
+    return np.ascontiguousarray(vectors, dtype=np.float32)
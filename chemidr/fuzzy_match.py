@@ -0,0 +1,227 @@
+"""
+    Purpose: Approximate string matching of many chemical strings against a large list of names (e.g. all FooDB
+    compounds or a synonym list), instead of one fuzz.ratio call per pair
+
+    Matching runs in three steps:
+        1. candidate index: an inverted character n-gram index (sparse name x n-gram matrix). A block of queries
+           is multiplied against it to count the n-grams every query shares with every name
+        2. filtering: the fuzz.ratio threshold bounds the indel distance of a match, which in turn bounds the
+           length difference and the number of shared n-grams, so most pairs are dropped without scoring
+        3. batched scoring: the surviving pairs of a block are scored together with fuzz.ratio (rapidfuzz's
+           vectorized cpdist when it is installed, fuzzywuzzy otherwise)
+
+    Example Usage:
+        index = FuzzyIndex(['allicin', 'diallyl disulfide'], ids=[1, 2])
+        index.match(['alicin', 'diallyl disulphide', 'water'], threshold=90)
+"""
+
+import pandas as pd
+import numpy as np
+from scipy import sparse
+
+try:
+    from rapidfuzz import fuzz
+    from rapidfuzz.process import cpdist
+except ImportError:
+    from fuzzywuzzy import fuzz
+    cpdist = None
+
+
+# Characters used to pad strings so that the start and end of a string get their own n-grams
+__PAD_START__ = '\x02'
+__PAD_END__ = '\x03'
+
+
+def __ngrams__(s, q):
+    padded = __PAD_START__ * (q - 1) + s + __PAD_END__ * (q - 1)
+    return {padded[i : i + q] for i in range(len(padded) - q + 1)}
+
+
+def score_pairs(s1, s2):
+    """
+        Scores two equal length sequences of strings pairwise with fuzz.ratio
+
+        Input
+        ----------------------------------------------------------------
+        s1 : list
+            first string of every pair
+        s2 : list
+            second string of every pair
+
+        Returns
+        ----------------------------------------------------------------
+        scores : np.ndarray
+            integer fuzz.ratio of every pair, rounded like fuzzywuzzy so thresholds behave the same
+    """
+    if len(s1) == 0:
+        return np.zeros(0)
+
+    if cpdist is not None:
+        scores = np.round(cpdist(list(s1), list(s2), scorer=fuzz.ratio, workers=-1))
+    else:
+        scores = np.array([fuzz.ratio(a, b) for a, b in zip(s1, s2)], dtype=np.float64)
+
+    # fuzzywuzzy scores a comparison with an empty string as 0
+    empty = np.array([len(a) == 0 or len(b) == 0 for a, b in zip(s1, s2)])
+    scores[empty] = 0
+
+    return scores
+
+
+class FuzzyIndex:
+    """
+        Input
+        ----------------------------------------------------------------
+        names : list
+            names to match against
+        ids : list (default None)
+            id of each name, defaults to the position of the name
+        q : int (default 3)
+            n-gram length of the candidate index
+        processor : function (default None)
+            applied to names and queries before indexing and scoring
+    """
+    def __init__(self, names, ids=None, q=3, processor=None):
+        self.q = q
+        self.processor = processor
+        self.names = np.asarray(names, dtype=object)
+        self.ids = np.arange(len(self.names)) if ids is None else np.asarray(ids)
+        self.keys = self.__process__(self.names)
+        self.lengths = np.array([len(k) for k in self.keys], dtype=np.int64)
+
+        self.vocab = {}
+        grams, self.gram_counts = self.__gram_matrix__(self.keys, grow=True)
+
+        # Stored transposed (n-gram x name) so a block of queries is a single sparse product
+        self.grams_t = grams.T.tocsr()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __process__(self, strings):
+        if self.processor is None:
+            return np.array([str(s) for s in strings], dtype=object)
+
+        return np.array([self.processor(str(s)) for s in strings], dtype=object)
+
+    # Binary string x n-gram matrix, plus the number of distinct n-grams of every string. Query n-grams that
+    # are not in the vocabulary can not be shared with any name, but still count towards the string's total
+    def __gram_matrix__(self, keys, grow=False):
+        rows, cols = [], []
+        counts = np.zeros(len(keys), dtype=np.int64)
+
+        for i, key in enumerate(keys):
+            grams = __ngrams__(key, self.q)
+            counts[i] = len(grams)
+
+            for g in grams:
+                col = self.vocab.get(g)
+
+                if col is None:
+                    if not grow:
+                        continue
+
+                    col = self.vocab[g] = len(self.vocab)
+
+                rows.append(i)
+                cols.append(col)
+
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(keys), len(self.vocab))
+        )
+
+        return matrix, counts
+
+    def __block_candidates__(self, grams, counts, lengths, threshold):
+        overlap = (grams @ self.grams_t).tocoo()
+        qi, ci, shared = overlap.row, overlap.col, overlap.data
+
+        l1, l2 = lengths[qi], self.lengths[ci]
+
+        # fuzz.ratio = 100 * (1 - indel / (l1 + l2)) is rounded before the comparison, so a match can have an
+        # indel distance of at most (1 - (threshold - .5) / 100) * (l1 + l2). The distance is at least the
+        # length difference, and each edit changes at most q of the distinct n-grams of either string
+        max_dist = np.floor((1 - (threshold - .5) / 100) * (l1 + l2))
+        min_shared = np.maximum(counts[qi], self.gram_counts[ci]) - self.q * max_dist
+
+        keep = (np.abs(l1 - l2) <= max_dist) & (shared >= min_shared)
+
+        return qi[keep], ci[keep]
+
+    def match(self, queries, threshold=98, best=True, block_size=1000):
+        """
+            Matches queries against the indexed names
+
+            Candidate pairs must share at least one n-gram, which only loses matches for strings so short that
+            the threshold allows every n-gram to differ
+
+            Input
+            ----------------------------------------------------------------
+            queries : pd.Series or list
+                strings to match, each distinct string is only matched once
+            threshold : float (default 98)
+                minimum fuzz.ratio of a match
+            best : bool (default True)
+                only return the best match of each query
+            block_size : int (default 1000)
+                distinct queries scored together
+
+            Returns
+            ----------------------------------------------------------------
+            matches : pd.DataFrame
+                if best, one row per query (sharing the index of queries if it is a Series) with the matched
+                'name', its 'id' and the 'score', np.nan where nothing passes the threshold. Otherwise one row
+                per passing pair with the position of the 'query' in queries
+        """
+        queries = pd.Series(queries) if not isinstance(queries, pd.Series) else queries
+        codes, uniques = pd.factorize(queries)
+
+        keys = self.__process__(uniques)
+        lengths = np.array([len(k) for k in keys], dtype=np.int64)
+        grams, counts = self.__gram_matrix__(keys)
+
+        found_q, found_c, found_s = [], [], []
+        for start in range(0, len(keys), block_size):
+            stop = start + block_size
+            qi, ci = self.__block_candidates__(grams[start:stop], counts[start:stop], lengths[start:stop], threshold)
+            qi = qi + start
+
+            scores = score_pairs(keys[qi], self.keys[ci])
+            passing = scores >= threshold
+
+            found_q.append(qi[passing])
+            found_c.append(ci[passing])
+            found_s.append(scores[passing])
+
+        pairs = pd.DataFrame({
+            'unique' : np.concatenate(found_q) if found_q else np.zeros(0, dtype=np.int64),
+            'candidate' : np.concatenate(found_c) if found_c else np.zeros(0, dtype=np.int64),
+            'score' : np.concatenate(found_s) if found_s else np.zeros(0),
+        })
+
+        if best:
+            # Highest score wins, ties go to the name indexed first
+            pairs = pairs.sort_values(['unique', 'score', 'candidate'], ascending=[True, False, True])
+            pairs = pairs.drop_duplicates(subset='unique', keep='first').set_index('unique')
+
+            per_unique = pd.DataFrame({
+                'name' : pd.Series(self.names[pairs.candidate.to_numpy()], index=pairs.index, dtype=object),
+                'id' : pd.Series(self.ids[pairs.candidate.to_numpy()], index=pairs.index),
+                'score' : pairs.score,
+            }).reindex(np.arange(len(uniques)))
+
+            matches = per_unique.reindex(codes)
+            matches.index = queries.index
+
+            return matches
+
+        # Expands the distinct query matches back to every query position
+        positions = pd.DataFrame({'query' : np.arange(len(codes)), 'unique' : codes})
+        pairs = positions.merge(pairs, on='unique').sort_values(['query', 'score'], ascending=[True, False])
+
+        return pd.DataFrame({
+            'query' : pairs['query'].to_numpy(),
+            'name' : self.names[pairs.candidate.to_numpy()],
+            'id' : self.ids[pairs.candidate.to_numpy()],
+            'score' : pairs.score.to_numpy(),
+        })
@@ -1,12 +1,24 @@
 
 import numpy as np
+import pandas as pd
 import math
 import urllib.request as request
-import requests
 import time
 import json
+import csv
 from lxml import etree
 
+from .transport import safe_urlopen as __safe_urlopen__, TransportError, CircuitOpenError
+from .chebi import fetch_hierarchy
+from .index import StringIndex, build_string_index
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from itertools import islice
+
+
+# Local MeSH to sid / cid crosswalk, checked by the mesh functions before searching (see set_mesh_index)
+__mesh_index__ = None
+
 
 def cid2prop(cid, prop):
 	# Create url for InChI query
@@ -22,7 +34,7 @@ def cid2prop(cid, prop):
 	return prop_value
 
 
-def cids2props(cids, prop, as_dict=False):
+def cids2props(cids, prop, as_dict=False, workers=4):
 	"""
 	    Retrieves properties from PubChem using Pubchem CIDS
 	    See property section of https://pubchemdocs.ncbi.nlm.nih.gov/pug-rest$_Toc494865567
@@ -33,6 +45,8 @@ def cids2props(cids, prop, as_dict=False):
 	        list of pubchem cid's for properties (needs to be ints, but also included int typecast)
 	    as_dict : bool (default False)
 	        returns dictionary of info if true, list otherwise
+	    workers : int (default 4)
+	        number of batches requested at once (see __dispatch_batches__)
 
 	    Returns
 	    ----------------------------------------------------------------
@@ -40,45 +54,20 @@ def cids2props(cids, prop, as_dict=False):
 	        dictionary with CID's as keys and properties as values if as_dict is True, otherwise list
 	        of properties to preserve order
 	"""
-	cids = __divide_list__([str(int(i)) for i in cids])
-
-	if as_dict: props = {}
-	else: props = []
-
-	# Loop over divisions of ids to avoid overloading query
-	for ids in cids:
-
-		# Create url for InChI query
-		url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{','.join(ids)}/property/{prop}/JSON"
-
-		r = __safe_urlopen__(url)
+	batches = __dispatch_batches__(
+		[str(int(i)) for i in cids], lambda ids: __fetch_props__(ids, prop),
+		fallback=lambda ids: batch_error_handler(ids, prop, as_dict=True).items(), workers=workers
+	)
 
-		if r is None:
-			new_props = batch_error_handler(ids, prop, as_dict=as_dict)
-
-			if as_dict: props.update(new_props)
-			else: props += new_props
+	# option to return InChIKey's as list or as dict (dict has certainty in case some cids aren't
+	# retrieved, list preserves order)
+	props = dict(pair for batch in batches for pair in batch)
 
-			continue
+	if as_dict: return props
+	else: return [props.get(int(cid), np.nan) for cid in cids]
 
-		# option to return InChIKey's as list or as dict (dict has certainty in case some cids aren't
-		# retrieved, list preserves order)
-		if as_dict:
-			new_dict = {
-				p['CID'] : __safe_object_access__(p, prop) for p in json.loads(r)['PropertyTable']['Properties']
-			}
-			props.update(new_dict)
-
-		else:
-			new_list = [
-				__safe_object_access__(p, prop) for p in json.loads(r)['PropertyTable']['Properties']
-			]
-			props += new_list
 
-	return props
-
-
-def cids2names(cids, as_dict=False):
+def cids2names(cids, as_dict=False, workers=4):
 	"""
 	    Retrieves properties from PubChem using Pubchem CIDS
 	    See property section of https://pubchemdocs.ncbi.nlm.nih.gov/pug-rest$_Toc494865567
@@ -89,6 +78,8 @@ def cids2names(cids, as_dict=False):
 	        list of pubchem cid's for properties (needs to be ints, but also included int typecast)
 	    as_dict : bool (default False)
 	        returns dictionary of info if true, list otherwise
+	    workers : int (default 4)
+	        number of batches requested at once (see __dispatch_batches__)
 
 	    Returns
 	    ----------------------------------------------------------------
@@ -96,55 +87,89 @@ def cids2names(cids, as_dict=False):
 	        dictionary with CID's as keys and chemical names as values if as_dict is True, otherwise list
 	        of chemical names to preserve order
 	"""
-	cids = __divide_list__([str(int(i)) for i in cids])
+	# Failed batches are split until the cids without synonyms are isolated (see batch_error_handler)
+	batches = __dispatch_batches__(
+		[str(int(i)) for i in cids], __fetch_names__,
+		fallback=lambda ids: __bisect_batch__(ids, __fetch_names__, lambda cid: (int(cid), np.nan)), workers=workers
+	)
 
-	if as_dict: names = {}
-	else: names = []
+	# option to return InChIKey's as list or as dict (dict has certainty in case some cids aren't
+	# retrieved, list preserves order)
+	names = dict(pair for batch in batches for pair in batch)
 
-	# Loop over divisions of ids to avoid overloading query
-	for ids in cids:
+	if as_dict: return names
+	else: return [names.get(int(cid), np.nan) for cid in cids]
 
-		# Create url for InChI query
-		url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{','.join(ids)}/synonyms/JSON"
 
-		r = __safe_urlopen__(url)
+# (cid, property value) pairs of a batch of cids, None if the batch failed
+def __fetch_props__(ids, prop):
+	r = __post_cids__(f'property/{prop}/JSON', ids)
 
-		# if r is None:
-		# 	new_names = batch_error_handler(ids, prop, as_dict=as_dict)
+	if r is None:
+		return None
 
-		# 	if as_dict: names.update(new_names)
-		# 	else: names += new_names
+	return [(p['CID'], __safe_object_access__(p, prop)) for p in json.loads(r)['PropertyTable']['Properties']]
+
+
+# (cid, synonym list) pairs of a batch of cids, None if the batch failed
+def __fetch_names__(ids):
+	r = __post_cids__('synonyms/JSON', ids)
+
+	if r is None:
+		return None
+
+	return [(p['CID'], __safe_object_access__(p, 'Synonym')) for p in json.loads(r)['InformationList']['Information']]
+
+
+def __bisect_batch__(ids, fetch, missing):
+	"""
+	    Recovers the results of a failed batch by fetching its halves, and splitting any half that fails again
+	    until the ids that make it fail are isolated. Costs about log2(len(ids)) requests per bad id instead of
+	    one request per id
+
+	    Input
+	    ----------------------------------------------------------------
+	    ids : list
+	        ids of the failed batch
+	    fetch : function
+	        takes a batch of ids and returns a list of results, or None if the batch failed
+	    missing : function
+	        takes an isolated id that failed and returns its placeholder result
+
+	    Returns
+	    ----------------------------------------------------------------
+	    results : list
+	        results of the halves in the order of ids
+	"""
+	if len(ids) == 1:
+		return [missing(ids[0])]
 
-		# 	continue
+	half = len(ids) // 2
+	results = []
 
-		# option to return InChIKey's as list or as dict (dict has certainty in case some cids aren't
-		# retrieved, list preserves order)
-		if as_dict:
-			new_dict = {
-				p['CID'] : __safe_object_access__(p, 'Synonym') for p in json.loads(r)['InformationList']['Information']
-			}
-			names.update(new_dict)
+	for part in [ids[:half], ids[half:]]:
+		r = fetch(part)
 
+		if r is None:
+			results += __bisect_batch__(part, fetch, missing)
 		else:
-			new_list = [
-				__safe_object_access__(p, 'Synonym') for p in json.loads(r)['InformationList']['Information']
-			]
-			names += new_list
+			results += r
 
-	return names
+	return results
 
 
 def batch_error_handler(cids, prop, as_dict=False):
-	if as_dict: props = {}
-	else: props = []
-
-	for cid in cids:
-		val = cid2prop(cid, prop)
-		
-		if as_dict: props.update({cid : val})
-		else: props += [val]
-	
-	return props
+	"""
+	    Retrieves the properties of a batch of cids that failed as a whole, by bisecting it (see __bisect_batch__)
+	    so the cids that make it fail get np.nan and the rest get their property
+	"""
+	pairs = __bisect_batch__(
+		[str(int(cid)) for cid in cids], lambda ids: __fetch_props__(ids, prop), lambda cid: (int(cid), np.nan)
+	)
+	props = dict(pairs)
+
+	if as_dict: return props
+	else: return [props.get(int(cid), np.nan) for cid in cids]
 
 
 def cids2inchis(cids, as_dict=False, use_prefix=False, keys = True):
@@ -177,8 +202,11 @@ def cids2inchis(cids, as_dict=False, use_prefix=False, keys = True):
 	inchikeys = cids2props(cids, query_type, as_dict=as_dict)
 
 	if use_prefix:
-		if isinstance(inchikeys, dict): inchikeys = {cid : ikey.split('-')[0] for cid, ikey in inchikeys.items()}
-		else: inchikeys = [ikey.split('-')[0] for ikey in inchikeys]
+		# Keys that were not retrieved stay np.nan
+		if isinstance(inchikeys, dict):
+			inchikeys = {cid : ikey.split('-')[0] if isinstance(ikey, str) else ikey for cid, ikey in inchikeys.items()}
+		else:
+			inchikeys = [ikey.split('-')[0] if isinstance(ikey, str) else ikey for ikey in inchikeys]
 
 	return inchikeys
 
@@ -201,52 +229,328 @@ def cids2smiles(cids, as_dict=False):
 	return SMILES
 
 
-# Divides list into even divisions with a maximum of 100 elements
-def __divide_list__(ids):
-	num_divisions = int(math.ceil(len(ids) / 100))
+# Properties that PUG-REST returns as numbers (or numeric strings, e.g. MolecularWeight)
+__NUMERIC_PROPS__ = {
+	'MolecularWeight', 'ExactMass', 'MonoisotopicMass', 'XLogP', 'TPSA', 'Complexity', 'Charge',
+	'HBondDonorCount', 'HBondAcceptorCount', 'RotatableBondCount', 'HeavyAtomCount', 'IsotopeAtomCount',
+	'AtomStereoCount', 'DefinedAtomStereoCount', 'UndefinedAtomStereoCount', 'BondStereoCount',
+	'DefinedBondStereoCount', 'UndefinedBondStereoCount', 'CovalentUnitCount', 'Volume3D',
+	'XStericQuadrupole3D', 'YStericQuadrupole3D', 'ZStericQuadrupole3D', 'FeatureCount3D',
+	'FeatureAcceptorCount3D', 'FeatureDonorCount3D', 'FeatureAnionCount3D', 'FeatureCationCount3D',
+	'FeatureRingCount3D', 'FeatureHydrophobeCount3D', 'ConformerModelRMSD3D', 'EffectiveRotorCount3D',
+	'ConformerCount3D',
+}
+
+
+# Builds the typed property table of cids2table from PUG-REST property records
+def __property_table__(records, cids, props):
+	table = pd.DataFrame.from_records(records, columns=['CID'] + props)
+	table = table.drop_duplicates(subset='CID').set_index('CID')
+	table = table.reindex(pd.Index(cids, name='CID'))
+
+	for prop in props:
+		if prop in __NUMERIC_PROPS__:
+			table[prop] = pd.to_numeric(table[prop], errors='coerce')
+		else:
+			table[prop] = table[prop].astype(object)
 
-	split_ids = np.array_split(np.asarray(ids), num_divisions)
-	split_ids = [np.ndarray.tolist(split_ids[i]) for i in range(len(split_ids))]
+	return table
 
-	return split_ids
 
+def cids2table(cids, props, workers=4):
+	"""
+	    Retrieves several properties from PubChem at once, with one request per batch of cids
+	    See property section of https://pubchemdocs.ncbi.nlm.nih.gov/pug-rest$_Toc494865567
 
-def __safe_urlopen__(url):
-    """
-        Retrieves information from url query without throwing errors, such as for values that do not
-        exist or excessive querying. Designed for Pubchem and Pubmed apis
+	    Input
+	    ----------------------------------------------------------------
+	    cids : list
+	        list of pubchem cid's for properties (needs to be ints, but also included int typecast)
+	    props : list
+	        property names, e.g. ['InChIKey', 'CanonicalSMILES', 'IUPACName']
+	    workers : int (default 4)
+	        number of batches requested at once (see __dispatch_batches__)
 
-        Input
-        ----------------------------------------------------------------
-        url : str
-            url to query
+	    Returns
+	    ----------------------------------------------------------------
+	    table : pd.DataFrame
+	        one row per cid in the order of cids, indexed by CID with a column per property. Numeric
+	        properties are numeric columns, and properties that are missing for a cid are np.nan
+	"""
+	cids = [int(i) for i in cids]
+	props = list(props)
+	tables = list(iter_cids2table(cids, props, workers=workers))
 
-        Returns
-        ----------------------------------------------------------------
-        response.content : str (maybe bytes) or None
-            Returns the response of a url query if it exists, else None
-    """
-    try:
-        response = requests.get(url)
-    except TimeoutError:
-        time.sleep(.5)
-        return __safe_urlopen__(url)
+	if len(tables) == 0:
+		return __property_table__([], cids, props)
+
+	return pd.concat(tables)
+
+
+# POSTs a list of cids to a PUG-REST compound operation, so batch size is not limited by url length
+def __post_cids__(operation, ids):
+	url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{operation}"
+
+	return __safe_urlopen__(url, data={'cid' : ','.join(ids)})
+
+
+class AdaptiveBatchSize:
+	"""
+	    Batch size that follows the observed latency and error rate of the api. It grows by half while batches
+	    come back well under target_latency, shrinks by a quarter when they take longer, and halves after a
+	    failed batch
+
+	    Input
+	    ----------------------------------------------------------------
+	    size : int (default 100)
+	        starting batch size
+	    min_size : int (default 10)
+	        smallest batch size
+	    max_size : int (default 1000)
+	        largest batch size
+	    target_latency : float (default 5)
+	        seconds a batch should take
+	"""
+	def __init__(self, size=100, min_size=10, max_size=1000, target_latency=5.):
+		self.size = size
+		self.min_size = min_size
+		self.max_size = max_size
+		self.target_latency = target_latency
+
+	def success(self, latency):
+		if latency < self.target_latency / 2:
+			self.size = min(self.max_size, self.size + max(1, self.size // 2))
+		elif latency > self.target_latency:
+			self.size = max(self.min_size, self.size * 3 // 4)
+
+	def failure(self):
+		self.size = max(self.min_size, self.size // 2)
+
+
+def __iter_batches__(ids, fetch, fallback=None, workers=4, batch_size=None, max_buffered=None):
+	"""
+	    Sends ids to fetch in batches, keeping up to workers batches in flight, and yields every batch as soon
+	    as it and all batches before it are done. Requests are still paced by the per-host rate limit in
+	    transport, so more workers only overlap the latency of the batches
+
+	    New batches are only sent while the consumer keeps pulling results, and their ids are only taken from
+	    the input when they are sent, so memory stays bounded by the batches in flight plus those waiting to
+	    be yielded in order, even for a lazy input of any length
+
+	    Input
+	    ----------------------------------------------------------------
+	    ids : iterable
+	        ids to fetch (as str), read as batches are sent
+	    fetch : function
+	        takes a batch of ids and returns a list of results, or None if the batch failed
+	    fallback : function (default None)
+	        takes the ids of a failed batch and returns their results
+	    workers : int (default 4)
+	        number of batches requested at once
+	    batch_size : AdaptiveBatchSize (default None)
+	        batch size policy, defaults to AdaptiveBatchSize()
+	    max_buffered : int (default None)
+	        maximum number of ids that are in flight or fetched but not yet yielded (at least 1), unbounded
+	        if None
+
+	    Returns
+	    ----------------------------------------------------------------
+	    batches : generator
+	        (batch ids, batch results) for every batch, in the order of ids
+	"""
+	if max_buffered is not None and max_buffered < 1:
+		raise ValueError(f'max_buffered must be at least 1, got {max_buffered}')
+
+	sizer = AdaptiveBatchSize() if batch_size is None else batch_size
+	workers = max(1, workers)
+
+	def run(batch):
+		start = time.monotonic()
+		result = fetch(batch)
+		latency = time.monotonic() - start
+
+		if result is None and fallback is not None:
+			return fallback(batch), latency, False
+
+		return result, latency, result is not None
+
+	ids = iter(ids)
+	exhausted = False # all ids have been taken from the input
+	ready = {} # finished batches by start position, waiting for the batches before them
+	pending = deque() # batches that timed out, split to be retried before new ids are sent
+	pos = 0 # position of the next id to send
+	next_start = 0 # position of the next batch to yield
+	buffered = 0
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		in_flight = {}
+
+		while not exhausted or in_flight or pending or ready:
+			while next_start in ready:
+				batch, result = ready.pop(next_start)
+				next_start += len(batch)
+				buffered -= len(batch)
+
+				yield batch, result
+
+			while len(in_flight) < workers and (pending or not exhausted):
+				if pending:
+					start, batch = pending.popleft()
+				else:
+					size = sizer.size
+
+					if max_buffered is not None:
+						size = min(size, max_buffered - buffered)
+
+						if size <= 0:
+							break
+
+					batch = list(islice(ids, size))
+
+					if len(batch) == 0:
+						exhausted = True
+						break
+
+					start = pos
+					pos += len(batch)
+					buffered += len(batch)
+
+				in_flight[pool.submit(run, batch)] = (start, batch)
+
+			if not in_flight:
+				continue
+
+			done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+			for future in done:
+				start, batch = in_flight.pop(future)
+
+				try:
+					result, latency, ok = future.result()
+				except CircuitOpenError:
+					raise
+				except TransportError:
+					# Large batches can time out on the server, retry the batch as two smaller ones
+					sizer.failure()
+
+					if len(batch) == 1:
+						raise
+
+					half = len(batch) // 2
+					pending.extend([(start, batch[:half]), (start + half, batch[half:])])
+					continue
+
+				if ok: sizer.success(latency)
+				else: sizer.failure()
+
+				ready[start] = (batch, result)
+
+
+def __dispatch_batches__(ids, fetch, fallback=None, workers=4, batch_size=None):
+	"""
+	    Collects the results of every batch of __iter_batches__ into a list, in the order of ids
+	"""
+	return [result for _, result in __iter_batches__(ids, fetch, fallback=fallback, workers=workers, batch_size=batch_size)]
 
-    if response.status_code == 200: # Successful
-        return response.content
 
-    elif response.status_code == 429: # Too many requests
-        # print('Retrying...')
-        time.sleep(.5)
-        return __safe_urlopen__(url)
+def iter_cids2props(cids, prop, workers=4, max_buffered=None):
+	"""
+	    Streaming form of cids2props, yields results while the remaining batches are still being fetched
+
+	    Input
+	    ----------------------------------------------------------------
+	    cids : iterable
+	        pubchem cid's for properties
+	    prop : str
+	        property name
+	    workers : int (default 4)
+	        number of batches requested at once
+	    max_buffered : int (default None)
+	        maximum number of cids fetched ahead of the consumer, unbounded if None
+
+	    Returns
+	    ----------------------------------------------------------------
+	    props : generator
+	        (cid, property) pairs in the order of cids, np.nan for properties that are not retrieved
+	"""
+	batches = __iter_batches__(
+		(str(int(i)) for i in cids), lambda ids: __fetch_props__(ids, prop),
+		fallback=lambda ids: batch_error_handler(ids, prop, as_dict=True).items(), workers=workers,
+		max_buffered=max_buffered
+	)
+
+	for ids, result in batches:
+		props = dict(result)
+
+		for cid in ids:
+			yield int(cid), props.get(int(cid), np.nan)
+
+
+def iter_cids2names(cids, workers=4, max_buffered=None):
+	"""
+	    Streaming form of cids2names, yields (cid, synonym list) pairs in the order of cids while the remaining
+	    batches are still being fetched (see iter_cids2props)
+	"""
+	batches = __iter_batches__(
+		(str(int(i)) for i in cids), __fetch_names__,
+		fallback=lambda ids: __bisect_batch__(ids, __fetch_names__, lambda cid: (int(cid), np.nan)), workers=workers,
+		max_buffered=max_buffered
+	)
+
+	for ids, result in batches:
+		names = dict(result)
+
+		for cid in ids:
+			yield int(cid), names.get(int(cid), np.nan)
+
+
+def iter_cids2inchis(cids, use_prefix=False, keys=True, workers=4, max_buffered=None):
+	"""
+	    Streaming form of cids2inchis, yields (cid, InChIKey) pairs in the order of cids while the remaining
+	    batches are still being fetched (see iter_cids2props)
+	"""
+	query_type = 'InChIKey' if keys else 'InChI'
+
+	for cid, ikey in iter_cids2props(cids, query_type, workers=workers, max_buffered=max_buffered):
+		if use_prefix and isinstance(ikey, str):
+			ikey = ikey.split('-')[0]
+
+		yield cid, ikey
+
+
+def iter_cids2table(cids, props, workers=4, max_buffered=None):
+	"""
+	    Streaming form of cids2table, yields one pd.DataFrame per batch (indexed by CID, in the order of cids)
+	    while the remaining batches are still being fetched (see iter_cids2props)
+	"""
+	props = list(props)
+
+	def fetch(ids):
+		r = __post_cids__(f"property/{','.join(props)}/JSON", ids)
 
-    elif response.status_code == 503: # PUGREST.ServerBusy
-        # print('Retrying...')
-        time.sleep(1)
-        return __safe_urlopen__(url)
+		if r is None:
+			return None
+
+		return json.loads(r)['PropertyTable']['Properties']
+
+	batches = __iter_batches__(
+		(str(int(i)) for i in cids), fetch,
+		fallback=lambda ids: __bisect_batch__(ids, fetch, lambda cid: {'CID' : int(cid)}), workers=workers,
+		max_buffered=max_buffered
+	)
+
+	for ids, records in batches:
+		yield __property_table__(records, [int(cid) for cid in ids], props)
+
+
+# Divides list into even divisions with a maximum of 100 elements
+def __divide_list__(ids):
+	num_divisions = int(math.ceil(len(ids) / 100))
 
-    elif response.status_code == 404: # PUGREST.NotFound (aka doesn't exist)
-        return None
+	split_ids = np.array_split(np.asarray(ids), num_divisions)
+	split_ids = [np.ndarray.tolist(split_ids[i]) for i in range(len(split_ids))]
+
+	return split_ids
 
 
 ### Antiquated and might be removed in future
@@ -277,9 +581,64 @@ def cid2smile(cid):
     return SMILE
 
 
+def build_mesh_index(sid_map_path, path, source='MeSH', chunksize=10 ** 6):
+	"""
+	    Builds a local MeSH to sid / cid crosswalk from PubChem's SID-Map
+	    (https://ftp.ncbi.nlm.nih.gov/pubchem/Substance/Extras/SID-Map), which lists the depositor, registry id
+	    and standardized cid of every substance
+
+	    Input
+	    ----------------------------------------------------------------
+	    sid_map_path : str
+	        location of the tab separated sid / source / registry id / cid file (may be gzipped)
+	    path : str
+	        directory to write the index to
+	    source : str (default 'MeSH')
+	        source name whose registry ids are MeSH ids
+	    chunksize : int (default 10 ** 6)
+	        lines of the map to read at once
+
+	    Returns
+	    ----------------------------------------------------------------
+	    index : StringIndex
+	        memory mapped index from MeSH id to 'sid' and 'cid'
+	"""
+	reader = pd.read_csv(
+		sid_map_path, sep='\t', header=None, names=['sid', 'source', 'mesh', 'cid'], dtype={'source' : str, 'mesh' : str},
+		quoting=csv.QUOTE_NONE, keep_default_na=False, na_values={'cid' : ['']}, chunksize=chunksize
+	)
+
+	# Only the MeSH deposits are kept, the map is sorted by sid so each id keeps its first substance
+	rows = pd.concat([chunk[chunk.source == source] for chunk in reader], ignore_index=True)
+	rows = rows.assign(mesh=rows.mesh.str.strip()).drop_duplicates(subset='mesh', keep='first')
+
+	build_string_index(path, rows.mesh, rows[['sid', 'cid']], keep='first')
+
+	return StringIndex(path)
+
+
+def set_mesh_index(path):
+	"""
+	    Answers MeSH lookups (mesh2pid, mesh2pids) from a crosswalk built by build_mesh_index, only MeSH ids
+	    that are not in it are searched online. None disables the local crosswalk
+	"""
+	global __mesh_index__
+
+	__mesh_index__ = None if path is None else StringIndex(path)
+
+
+# (sid, cid) of every mesh from the local crosswalk, np.nan where it is not indexed
+def __mesh_index_lookup__(meshes):
+	if __mesh_index__ is None:
+		return pd.DataFrame({'sid' : np.nan, 'cid' : np.nan}, index=range(len(meshes)))
+
+	return __mesh_index__.lookup([str(m).strip() for m in meshes])
+
+
 def mesh2pid(mesh):
 	"""
-	    Retrieves pubchem id's (both cid and sid) from Pubchem by searching the substances
+	    Retrieves pubchem id's (both cid and sid) from Pubchem by searching the substances, or from the local
+	    crosswalk if one is set (see set_mesh_index)
 
 	    Input
 	    ----------------------------------------------------------------
@@ -290,7 +649,13 @@ def mesh2pid(mesh):
 	    ----------------------------------------------------------------
 	    _ : dict (of dicts)
 	        dictionary with mesh id as keys, and dictionaries of mesh ids with corresponding cids and sids as values
+	        (int, np.nan where there is none), the same whether they come from the crosswalk or from PubChem
 	"""
+	local = __mesh_index_lookup__([mesh]).iloc[0]
+
+	if pd.notnull(local.sid):
+		return {mesh : {'mesh' : mesh, 'sid' : int(local.sid), 'cid' : int(local.cid) if pd.notnull(local.cid) else np.nan}}
+
 	url = f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pcsubstance&term={mesh}&retmode=json'
 
 	r = __safe_urlopen__(url)
@@ -299,23 +664,23 @@ def mesh2pid(mesh):
 		j = json.loads(r)
 
 		# No results from searching mesh id
-		if j['esearchresult']['count'] != 0:
+		if int(j['esearchresult']['count']) != 0:
 
-			sid = j['esearchresult']['idlist'][0] # get first sid result
+			sid = int(j['esearchresult']['idlist'][0]) # get first sid result
 
 			url = f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/substance/sid/{sid}/xml'
 
 			xml = __safe_urlopen__(url)
 
 			if xml is None:
-				return {mesh : {'mesh' : mesh, 'sid' : sid, 'cid' : cid}}
+				return {mesh : {'mesh' : mesh, 'sid' : sid, 'cid' : np.nan}}
 
 			root = etree.fromstring(xml)
 
 			cids = root.findall(".//{http://www.ncbi.nlm.nih.gov}PC-CompoundType_id_cid")
 
 			if len(cids) > 0:
-				cid = cids[0].xpath('./text()')[0]
+				cid = int(cids[0].xpath('./text()')[0])
 			else:
 				cid = np.nan # No cids
 
@@ -354,37 +719,131 @@ def mesh2pid(mesh):
 	# 		return {'mesh' : mesh, 'sid' : sid, 'cid' : cid}
 
 
-def cid2tax(cid, taxonomy='ChEBI'):
-	url = f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/classification/JSON'
+def mesh2pids(meshes, workers=4):
+	"""
+	    Batch form of mesh2pid. MeSH ids in the local crosswalk (see set_mesh_index) are answered from it. Every
+	    other distinct mesh is searched once (workers at a time, paced by the E-utilities rate limit, see
+	    transport.set_rate_limit for api keys), and the first sid of every mesh is mapped to its cid with
+	    batched PUG-REST substance requests
+
+	    Input
+	    ----------------------------------------------------------------
+	    meshes : list
+	        mesh ids for which to retrieve the Pubchem id's
+	    workers : int (default 4)
+	        number of searches (and sid batches) requested at once
+
+	    Returns
+	    ----------------------------------------------------------------
+	    pids : pd.DataFrame
+	        one row per distinct mesh in the order of meshes, with columns 'mesh', 'sid' and 'cid' (np.nan
+	        where there are none)
+	"""
+	meshes = list(dict.fromkeys(meshes))
+
+	pids = __mesh_index_lookup__(meshes)
+	pids.insert(0, 'mesh', meshes)
+	online = pids.sid.isnull().to_numpy()
+
+	with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+		sids = list(pool.map(__mesh2sid__, pids.mesh[online]))
+
+	found = list(dict.fromkeys(str(sid) for sid in sids if sid is not None))
+	sid2cid = {}
+
+	for result in __dispatch_batches__(
+		found, __fetch_sid_cids__, fallback=lambda ids: __bisect_batch__(ids, __fetch_sid_cids__, lambda sid: (int(sid), np.nan)),
+		workers=workers
+	):
+		sid2cid.update(result)
+
+	pids.loc[online, 'sid'] = [np.nan if sid is None else sid for sid in sids]
+	pids.loc[online, 'cid'] = [np.nan if sid is None else sid2cid.get(sid, np.nan) for sid in sids]
+
+	return pids[['mesh', 'sid', 'cid']]
+
+
+# First sid found by searching PubChem substances for a mesh, None if there is none
+def __mesh2sid__(mesh):
+	url = f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pcsubstance&term={mesh}&retmax=1&retmode=json'
 
 	r = __safe_urlopen__(url)
 
-	if r is None: return np.nan
+	if r is None:
+		return None
+
+	idlist = json.loads(r)['esearchresult'].get('idlist', [])
+
+	return int(idlist[0]) if len(idlist) > 0 else None
+
+
+# Fetches (sid, first cid) of a batch of sids (as str), None if the batch failed
+def __fetch_sid_cids__(ids):
+	url = 'https://pubchem.ncbi.nlm.nih.gov/rest/pug/substance/sid/cids/JSON'
+
+	r = __safe_urlopen__(url, data={'sid' : ','.join(ids)})
+
+	if r is None:
+		return None
+
+	info = json.loads(r)['InformationList']['Information']
 
-	all_taxonomies = json.loads(r)['Hierarchies']['Hierarchy']
+	return [(int(i['SID']), i['CID'][0] if len(i.get('CID', [])) > 0 else np.nan) for i in info]
 
-	# I think should only have one occurance of taxonomy source name
-	raw_tax = [all_taxonomies[t] for t in range(len(all_taxonomies)) if all_taxonomies[t]['SourceName'] == taxonomy]
 
-	if len(raw_tax) == 0: return np.nan
-	else: raw_tax = raw_tax[0]
+def cid2tax(cid, taxonomy='ChEBI'):
+	nodes = fetch_hierarchy(cid, taxonomy=taxonomy)
 
-	nodes = raw_tax['Node']
-	tax = []
+	if nodes is None or len(nodes) == 0: return np.nan
 
-	chebi_name = lambda x: x['Information']['Name']
-	chebi_id = lambda x: int(x['Information']['URL'].lstrip('http://www.ebi.ac.uk/chebi/searchId.do?chebiId=CHEBI:'))
+	return __first_branch__(nodes)
 
-	last_node = nodes[0]['NodeID']
-	tax.append( (chebi_name(nodes[0]), chebi_id(nodes[0])) )
-	n=1
 
-	while int(last_node.lstrip('node_')) >= int(nodes[n]['NodeID'].lstrip('node_')):
-		tax.append( (chebi_name(nodes[n]), chebi_id(nodes[n])) )
-		last_node = nodes[n]['NodeID']
-		n += 1
+def cids2tax(cids, taxonomy='ChEBI', as_dict=False, workers=4):
+	"""
+	    Retrieves the taxonomy of many cids (see cid2tax), downloading each distinct cid once with up to workers
+	    requests at a time. Use chebi.ChEBIStore with chebi.fetch_hierarchies to keep the hierarchies on disk
 
-		if n == len(nodes):
+	    Input
+	    ----------------------------------------------------------------
+	    cids : list
+	        list of pubchem cid's
+	    taxonomy : str (default 'ChEBI')
+	        classification source name
+	    as_dict : bool (default False)
+	        returns dictionary of info if true, list otherwise
+	    workers : int (default 4)
+	        number of classifications requested at once
+
+	    Returns
+	    ----------------------------------------------------------------
+	    tax : list or dict
+	        (name, id) list for every cid (np.nan if there is none), or a dictionary with cids as keys
+	"""
+	cids = [int(cid) for cid in cids]
+	unique = list(dict.fromkeys(cids))
+
+	with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+		hierarchies = pool.map(lambda cid: fetch_hierarchy(cid, taxonomy=taxonomy), unique)
+		tax = {cid : np.nan if not nodes else __first_branch__(nodes) for cid, nodes in zip(unique, hierarchies)}
+
+	if as_dict:
+		return tax
+
+	return [tax[cid] for cid in cids]
+
+
+# First branch of a parsed hierarchy as (name, id) pairs, the nodes from the start of the response up to where
+# the node numbering starts increasing again
+def __first_branch__(nodes):
+	number = lambda x: int(x['node'].lstrip('node_'))
+
+	tax = [(nodes[0]['name'], nodes[0]['chebi_id'])]
+
+	for prev, node in zip(nodes, nodes[1:]):
+		if number(prev) < number(node):
 			break
 
-	return tax
\ No newline at end of file
+		tax.append((node['name'], node['chebi_id']))
+
+	return tax
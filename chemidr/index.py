@@ -0,0 +1,247 @@
+"""
+    Purpose: Compact on-disk string-to-id index that can be memory mapped and queried for whole columns at once
+
+    Keys are stored as sorted 64-bit hashes next to a float matrix of ids, so an index of millions of strings
+    takes ~8 bytes per key plus 8 bytes per id column, loads instantly with np.load(mmap_mode='r'), and answers
+    a lookup for a full pd.Series with one np.searchsorted. Optional string labels (e.g. a primary name per key)
+    are stored once each in a single utf-8 blob with offsets, and every key points to its label by number, so
+    keys sharing a label (e.g. all synonyms of a compound) do not repeat it
+
+    Indexes too large to hold as strings can be built from their hashes with build_hashed_index
+
+    Example Usage:
+        build_string_index('intermediate_save/foodb_index', pd.Series(['allicin']), pd.DataFrame({'foodb_id' : [1.]}))
+        StringIndex('intermediate_save/foodb_index').lookup(pd.Series(['allicin', 'water']))
+"""
+
+import pandas as pd
+import numpy as np
+import json
+import os
+
+
+def hash_strings(terms):
+    """
+        Hashes strings to uint64 with pandas' stable siphash, so hashes match between index builds and lookups
+    """
+    return pd.util.hash_array(np.asarray(terms, dtype=object), categorize=False)
+
+
+def build_string_index(path, keys, values, labels=None, keep='first'):
+    """
+        Writes an index to a directory
+
+        Input
+        ----------------------------------------------------------------
+        path : str
+            directory to write the index files to, created if it does not exist
+        keys : pd.Series
+            strings to index, expected to already be normalized the same way lookups will be
+        values : pd.DataFrame
+            numeric id columns aligned with keys
+        labels : pd.Series (default None)
+            optional string aligned with keys, returned as a 'label' column by lookups
+        keep : str (default 'first')
+            which value to keep when a key occurs more than once ('first' or 'last')
+
+        Returns
+        ----------------------------------------------------------------
+        size : int
+            number of distinct keys in the index
+    """
+    columns = [str(c) for c in values.columns]
+
+    frame = pd.DataFrame(np.asarray(values, dtype=np.float64).reshape(len(keys), len(columns)), columns=columns)
+    frame['__key__'] = np.asarray(keys, dtype=object)
+
+    if labels is not None:
+        frame['__label__'] = np.asarray(labels, dtype=object)
+
+    frame = frame[frame['__key__'].notnull()].drop_duplicates(subset='__key__', keep=keep)
+
+    hashes = hash_strings(frame['__key__'])
+
+    if len(np.unique(hashes)) != len(hashes):
+        raise ValueError('Hash collision between distinct keys, index can not be built')
+
+    label_ids, blob, offsets = None, None, None
+
+    if labels is not None:
+        label_ids, uniques = pd.factorize(frame['__label__'].where(frame['__label__'].map(type) == str))
+        blob, offsets = encode_labels(uniques)
+
+    return build_hashed_index(path, hashes, frame[columns], label_ids=label_ids, label_blob=blob, label_offsets=offsets)
+
+
+def encode_labels(labels):
+    """
+        Encodes strings into the label storage of an index, returns the utf-8 blob (np.uint8) and the offsets of
+        every label in it (label i is blob[offsets[i] : offsets[i + 1]])
+    """
+    encoded = [l.encode('utf-8') for l in labels]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def build_hashed_index(path, hashes, values, label_ids=None, label_blob=None, label_offsets=None):
+    """
+        Writes an index from keys that are already hashed (with hash_strings), so the strings themselves never
+        have to be held in memory. Distinct keys with the same hash can not be told apart here, the first
+        occurrence of a hash is kept
+
+        Input
+        ----------------------------------------------------------------
+        path : str
+            directory to write the index files to, created if it does not exist
+        hashes : np.ndarray
+            uint64 hashes of the keys
+        values : pd.DataFrame
+            numeric id columns aligned with hashes
+        label_ids : np.ndarray (default None)
+            number of the label of every key (-1 for none), aligned with hashes
+        label_blob, label_offsets : np.ndarray (default None)
+            the labels, as returned by encode_labels
+
+        Returns
+        ----------------------------------------------------------------
+        size : int
+            number of distinct keys in the index
+    """
+    columns = [str(c) for c in values.columns]
+    values = np.asarray(values, dtype=np.float64).reshape(len(hashes), len(columns))
+
+    order = np.argsort(hashes, kind='stable')
+    hashes = np.asarray(hashes)[order]
+
+    # Keeps the first of every run of equal hashes
+    first = np.ones(len(hashes), dtype=bool)
+    first[1:] = hashes[1:] != hashes[:-1]
+    order = order[first]
+
+    os.makedirs(path, exist_ok=True)
+
+    np.save(f'{path}/hashes.npy', hashes[first])
+    np.save(f'{path}/values.npy', np.ascontiguousarray(values[order]))
+
+    if label_ids is not None:
+        np.save(f'{path}/label_ids.npy', np.asarray(label_ids, dtype=np.int64)[order])
+        np.save(f'{path}/labels.npy', label_blob)
+        np.save(f'{path}/label_offsets.npy', label_offsets)
+
+    with open(f'{path}/meta.json', 'w') as f:
+        json.dump({'columns' : columns, 'size' : len(order), 'labels' : label_ids is not None, 'label_ids' : True}, f)
+
+    return len(order)
+
+
+class StringIndex:
+    """
+        Read side of build_string_index
+
+        Input
+        ----------------------------------------------------------------
+        path : str
+            directory written by build_string_index
+        mmap : bool (default True)
+            memory map the index files instead of reading them into RAM
+    """
+    def __init__(self, path, mmap=True):
+        mode = 'r' if mmap else None
+
+        with open(f'{path}/meta.json') as f:
+            meta = json.load(f)
+
+        self.path = path
+        self.columns = meta['columns']
+        self.hashes = np.load(f'{path}/hashes.npy', mmap_mode=mode)
+        self.values = np.load(f'{path}/values.npy', mmap_mode=mode)
+
+        if meta['labels']:
+            self.labels = np.load(f'{path}/labels.npy', mmap_mode=mode)
+            self.label_offsets = np.load(f'{path}/label_offsets.npy', mmap_mode=mode)
+
+            # Indexes written before labels were shared store one label per key, in key order
+            self.label_ids = np.load(f'{path}/label_ids.npy', mmap_mode=mode) if meta.get('label_ids') else None
+        else:
+            self.labels = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, term):
+        return bool(self.__positions__([term])[0] >= 0)
+
+    # Position of every term in the index, -1 if the term is not indexed
+    def __positions__(self, terms):
+        hashes = hash_strings(terms)
+
+        if len(self.hashes) == 0:
+            return np.full(len(hashes), -1, dtype=np.int64)
+
+        pos = np.searchsorted(self.hashes, hashes)
+        pos[pos == len(self.hashes)] = 0
+
+        return np.where(self.hashes[pos] == hashes, pos, -1)
+
+    def lookup(self, terms):
+        """
+            Looks up a column of strings
+
+            Input
+            ----------------------------------------------------------------
+            terms : pd.Series or list
+                strings to look up, normalized the same way as the index keys
+
+            Returns
+            ----------------------------------------------------------------
+            matches : pd.DataFrame
+                one row per term (sharing the index of terms if it is a Series) with the id columns, and a
+                'label' column if the index has labels. Missing terms have np.nan in every column
+        """
+        index = terms.index if isinstance(terms, pd.Series) else None
+        pos = self.__positions__(terms)
+        found = pos >= 0
+
+        values = np.full((len(pos), len(self.columns)), np.nan)
+        values[found] = self.values[pos[found]]
+
+        matches = pd.DataFrame(values, columns=self.columns, index=index)
+
+        if self.labels is not None:
+            labels = np.full(len(pos), np.nan, dtype=object)
+            labels[found] = [self.__label__(p) for p in pos[found]]
+            matches['label'] = labels
+
+        return matches
+
+    # Label of the key at position p, np.nan if it has none
+    def __label__(self, p):
+        i = p if self.label_ids is None else self.label_ids[p]
+
+        if i < 0:
+            return np.nan
+
+        return bytes(self.labels[self.label_offsets[i] : self.label_offsets[i + 1]]).decode('utf-8')
+
+    def get(self, term):
+        """
+            Looks up a single string, returns a dict of the id columns (and label) or None if it is not indexed.
+            Answered with plain numpy scalars, use lookup for many strings at once
+        """
+        if len(self.hashes) == 0:
+            return None
+
+        h = hash_strings([term])[0]
+        p = int(np.searchsorted(self.hashes, h))
+
+        if p == len(self.hashes) or self.hashes[p] != h:
+            return None
+
+        match = dict(zip(self.columns, self.values[p].tolist()))
+
+        if self.labels is not None:
+            match['label'] = self.__label__(p)
+
+        return match
@@ -7,9 +7,14 @@
         append_foodb_id: adds column with foodb id's given a dataframe with chemical strings
         append_pubchem_id: adds column with pubchem ids's given a dataframe with chemical strings
         id_searcher: adds columns with foodb and pubchem id's, along with a composite column
+        id_searcher_stream: runs id_searcher chunk by chunk over a csv, with resumable checkpoints
+        normalize_terms: cleans a column of chemical strings into every form the pubchem tiers query
+        set_cache: keeps pubchem resolutions in a sqlite database so reruns skip the network
+        build_synonym_index / set_synonym_index: answers exact name lookups from a local PubChem synonym dump
 
     Example Usage:
         test = pd.DataFrame({'chem' : ['allicin', 'diallyl disulphide']})
+        set_cache('pubchem_cache.sqlite')
         id_searcher(test, 'chem')
 """
 
@@ -17,40 +22,126 @@ import pandas as pd
 import numpy as np
 import time
 # import urllib.request as request
-import requests
 from lxml import etree
 import json
 import math
-import pickle
 import re
-from fuzzywuzzy import fuzz
+import csv
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
-from .id_map import cids2inchis
+from .id_map import cids2inchis, cids2names
+from .transport import safe_urlopen as __safe_urlopen__, TransportError
+from .cache import ResolutionCache
+from .index import StringIndex, build_string_index, build_hashed_index, encode_labels, hash_strings
+from .fuzzy_match import FuzzyIndex, score_pairs
 
 import os
 cwd = os.path.dirname(__file__) # get current location of script
 package_path = 'Chemidr'.join(cwd.split('Chemidr')[:-1]) + 'Chemidr' # get path to head of Chemidr package
 
 
+# Cache of pubchem resolutions, disabled until set_cache is called
+__cache__ = None
+
+# Local synonym index for exact lookups, disabled until set_synonym_index is called
+__synonym_index__ = None
+__offline__ = False
+
+# Number of lookups that failed on the network since __resolve_terms__ started, those terms are left
+# unresolved and are not cached, so a rerun tries them again
+__failed_lookups__ = 0
+__failed_lock__ = threading.Lock()
+
+
 # Filepath wrapper to make data load-able from Chemidr
 def __make_fp__(fp):
     return f'{package_path}/{fp}'
-    
+
+
+def set_cache(path, ttl=30, miss_ttl=7):
+    """
+        Stores pubchem resolutions (including misses) in a sqlite database, so that resolving the same
+        terms again makes no network calls until the entries expire
+
+        Input
+        ----------------------------------------------------------------
+        path : str or None
+            location of the sqlite database, None disables the cache
+        ttl : float or None (default 30)
+            days before a cached hit expires, never expires if None
+        miss_ttl : float or None (default 7)
+            days before a cached miss expires, never expires if None
+    """
+    global __cache__
+
+    if __cache__ is not None:
+        __cache__.close()
+
+    __cache__ = None if path is None else ResolutionCache(path, ttl=ttl, miss_ttl=miss_ttl)
+
+
+def set_synonym_index(path, offline=False):
+    """
+        Answers exact name lookups from a synonym index (see build_synonym_index) before any request is made
+
+        Input
+        ----------------------------------------------------------------
+        path : str or None
+            directory of the synonym index, None disables the local tier
+        offline : bool (default False)
+            only use the local tier, terms that are not in the index get np.nan instead of falling back to
+            the pubchem apis (for batch nodes without network access)
+    """
+    global __synonym_index__, __offline__
+
+    __synonym_index__ = None if path is None else StringIndex(path)
+    __offline__ = offline and path is not None
+
+
+# Runs a resolution tier through the cache, keyed by the cleaned term and tier name
+def __cached_lookup__(tier, lookup, req):
+    if __cache__ is None:
+        return lookup(req)
+
+    result = __cache__.get(req, tier)
+
+    if result is None:
+        result = lookup(req)
+        __cache__.set(req, tier, *result)
+
+    return result
+
+
+def __record_failure__():
+    global __failed_lookups__
+
+    with __failed_lock__:
+        __failed_lookups__ += 1
+
+
+# Greek letters written as *~greek letter name~* in the chemical strings
+__GREEK_LETTERS__ = [('*alpha*', 'α', 'alpha'), ('*beta*', 'β', 'beta'), ('*gamma*', 'γ', 'gamma'),
+                     ('*rho*', 'ρ', 'rho'), ('*delta*', 'δ', 'delta')]
+
+__NUTRIENT_TERMS__ = ['protein', 'fat', 'sugar', 'carbohydrate', 'fiber', 'ash']
+
+# Substitutions of __clean_compound_name__, compiled once and shared with normalize_terms
+__COMPOUND_NAME_SUBS__ = [
+    (re.compile(r'[\+\-]'), ''), # Remove +/- from string
+    (re.compile(r's$'), ''), # Remove trailing s in string
+    (re.compile(r'[\s\-\(]cis[\s\-\)]|[\s\-\(]trans[\s\-\)]'), ''), # Remove cis/trans from string
+    (re.compile(r'[\s\-\(][a-z][\s\-\)]|^[a-z][\s\-]'), '-'), # Remove single alpha charachters surrounded by whitespace or '-'
+    (re.compile(r'-'), ' '), # Replace hyphen with space
+    (re.compile(r'\s+'), ' '), # Replace stretch of whitespace with space
+]
+
 
 # Convert text to greet letter using *~greek letter name~*
 def __greek_letter_converter__(chem, convert_letter = True):
-    if convert_letter:
-        chem = chem.replace('*alpha*', 'α')
-        chem = chem.replace('*beta*', 'β')
-        chem = chem.replace('*gamma*', 'γ')
-        chem = chem.replace('*rho*', 'ρ')
-        chem = chem.replace('*delta*', 'δ')
-    else:
-        chem = chem.replace('*alpha*', 'alpha')
-        chem = chem.replace('*beta*', 'beta')
-        chem = chem.replace('*gamma*', 'gamma')
-        chem = chem.replace('*rho*', 'rho')
-        chem = chem.replace('*delta*', 'delta')
+    for name, letter, text in __GREEK_LETTERS__:
+        chem = chem.replace(name, letter if convert_letter else text)
     return chem
 
 
@@ -90,40 +181,6 @@ def __clean_term__(term, convert_letter = True, w_space = True, is_url=True):
     return term
 
 
-def __safe_urlopen__(url):
-    """
-        Retrieves information from url query without throwing errors, such as for values that do not
-        exist or excessive querying. Designed for Pubchem and Pubmed apis
-
-        Input
-        ----------------------------------------------------------------
-        url : str
-            url to query
-
-        Returns
-        ----------------------------------------------------------------
-        response.content : str (maybe bytes) or None
-            Returns the response of a url query if it exists, else None
-    """
-    response = requests.get(url)
-
-    if response.status_code == 200: # Successful
-        return response.content
-
-    elif response.status_code == 429: # Too many requests
-        # print('Retrying...')
-        time.sleep(.5)
-        return __safe_urlopen__(url)
-
-    elif response.status_code == 503: # PUGREST.ServerBusy
-        # print('Retrying...')
-        time.sleep(1)
-        return __safe_urlopen__(url)
-
-    elif response.status_code == 404: # PUGREST.NotFound (aka doesn't exist)
-        return None
-
-
 def __exact_retrevial__(req):
     """
         retrieves pubchem synonym information using exact string matches and extracts the 
@@ -157,10 +214,11 @@ def __exact_retrevial__(req):
     return compound_id, compound_name
 
 
+# Case insensitive, so the per-string and the batch (lowercased) paths agree on the same term
 def __is_nutrient__(term):
-    general_terms = ['protein', 'fat', 'sugar', 'carbohydrate', 'fiber', 'ash']
-    
-    if sum([1 for t in general_terms if t in term]) > 0:
+    term = term.lower()
+
+    if sum([1 for t in __NUTRIENT_TERMS__ if t in term]) > 0:
         return True
     else:
         return False
@@ -169,42 +227,125 @@ def __is_nutrient__(term):
 def __clean_compound_name__(s):
     s = s.lower()
 
-    # Remove +/- from string
-    s = re.sub('[\+\-]', '', s)
+    for pattern, repl in __COMPOUND_NAME_SUBS__:
+        s = pattern.sub(repl, s)
 
-    # Remove trailing s in string
-    s = re.sub('s$', '', s)
+    s = s.strip()
 
-    # Remove cis/trans from string
-    s = re.sub('[\s\-\(]cis[\s\-\)]|[\s\-\(]trans[\s\-\)]', '', s)
+    return s
 
-    # Remove any single alpha charachters surrounded by whitespace or '-'
-    s = re.sub('[\s\-\(][a-z][\s\-\)]|^[a-z][\s\-]', '-', s)
 
-    # Replace hyphen with space
-    s = re.sub('-', ' ', s)
+# Every cleaned variant of a term, sharing the lowercasing and cleaning steps between the variants
+def __term_variants__(term, convert_letter=False):
+    lowered = term.lower()
+    cleaned = lowered.strip()
 
-    # Replace stretch of whitespace with space
-    s = re.sub('\s+', ' ', s)
+    if '*' in cleaned:
+        cleaned = __greek_letter_converter__(cleaned, convert_letter=convert_letter)
 
-    s = s.strip()
+    compound = lowered
+    for pattern, repl in __COMPOUND_NAME_SUBS__:
+        compound = pattern.sub(repl, compound)
+    compound = compound.strip().lower().strip()
 
-    return s
+    if '*' in compound:
+        compound = __greek_letter_converter__(compound, convert_letter=convert_letter)
+
+    return (
+        __is_nutrient__(lowered),
+        cleaned.replace(' ', '%20'),
+        cleaned.replace(' ', ''),
+        compound.replace(' ', '%20'),
+    )
+
+
+def normalize_terms(terms, convert_letter=False):
+    """
+        Batch form of the string cleaning done by get_compound_pubchem_info. Produces every variant of a
+        chemical string that the resolution tiers query in a single pass over the distinct strings, with
+        output identical to the per-string functions
+
+        Input
+        ----------------------------------------------------------------
+        terms : pd.Series
+            chemical strings
+        convert_letter : bool (default False)
+            Whether or not to convert letter to greek representation
+
+        Returns
+        ----------------------------------------------------------------
+        variants : pd.DataFrame
+            one row per term (sharing its index, all nan for missing terms) with columns
+                is_nutrient : general nutrient term that is not searched (__is_nutrient__)
+                url : cleaned and url escaped term (__clean_term__)
+                no_space : cleaned term without whitespace (__clean_term__ with w_space=False)
+                compound_url : cleaned compound name, url escaped
+                    (__clean_term__ of __clean_compound_name__)
+    """
+    codes, uniques = pd.factorize(terms)
+
+    variants = [__term_variants__(t, convert_letter=convert_letter) for t in uniques]
+    variants = np.array(variants + [(np.nan,) * 4], dtype=object).reshape(-1, 4)
 
+    return pd.DataFrame(
+        variants[codes], columns=['is_nutrient', 'url', 'no_space', 'compound_url'], index=terms.index
+    )
 
-def __complex_string_equivalence__(s1, s2):
+
+# Form of a compound name that is compared in fuzzy matches
+def __fuzzy_key__(s):
+    return ''.join(__clean_compound_name__(s).split())
+
+
+def __complex_string_equivalence__(s1, s2, threshold=98):
     # Remove parenthesis and anything in between
-    s1 = __clean_compound_name__(s1)
-    s2 = __clean_compound_name__(s2)
+    s1 = __fuzzy_key__(s1)
+    s2 = __fuzzy_key__(s2)
 
-    # Calculates fuzz ratio (Levenshtein Distance)
-    if fuzz.ratio(''.join(s1.split()), ''.join(s2.split())) >= 98:
+    # Calculates fuzz ratio (Levenshtein Distance) with the same scorer as the fuzzy foodb tier
+    if score_pairs([s1], [s2])[0] >= threshold:
         return True
     else:
         return False
 
 
-# Examples https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pccompound&term=allicin&retmode=json
+# Example https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pccompound&term=allicin&retmode=json
+def __esearch_top_cid__(req):
+    """
+        First phase of the search tier, searches the PubChem compound database with req and returns the top
+        hit. The search response is only parsed once
+
+        Returns
+        ----------------------------------------------------------------
+        cid : float
+            pubchem compound id of the top search result, np.nan if there are no results
+    """
+    url = f"https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pccompound&term={req.lower()}&retmode=json"
+
+    r = __safe_urlopen__(url)
+
+    if r is None:
+        return np.nan
+
+    result = json.loads(r)['esearchresult']
+
+    # Return np.nan for no search results
+    if int(result['count']) == 0:
+        return np.nan
+
+    return float(result['idlist'][0])
+
+
+# Last phase of the search tier, keeps the top hit if its primary name passes the complex equivalence test
+def __check_search_hit__(req, cid, name):
+    req = re.sub('%20', ' ', req.lower())
+
+    if isinstance(name, str) and __complex_string_equivalence__(req, name):
+        return cid, name
+
+    return np.nan, np.nan
+
+
 # https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/2244/synonyms/json
 def __compound_search__(req):
     """
@@ -222,26 +363,13 @@ def __compound_search__(req):
         name : str
             compound name of primary compound for synonym entry
     """
-    req = req.lower()
-
-    # Url to search for compound
-    url = f"https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pccompound&term={req}&retmode=json"
-
-    r = __safe_urlopen__(url)
+    cid = __esearch_top_cid__(req)
 
-    if r is None:
-        return np.nan, np.nan
-
-    req = re.sub('%20', ' ', req)
-
-    # Return np.nan for no search results
-    if int(json.loads(r)['esearchresult']['count']) == 0:
+    if math.isnan(cid):
         return np.nan, np.nan
 
-    cid = float(json.loads(r)['esearchresult']['idlist'][0])
-
     # Url to get the name associated with a cid
-    name_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/synonyms/json"
+    name_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{int(cid)}/synonyms/json"
 
     # a cid did not have synonyms for some reason
     jsn = __safe_urlopen__(name_url)
@@ -251,51 +379,174 @@ def __compound_search__(req):
 
     name = json.loads(jsn)['InformationList']['Information'][0]['Synonym'][0]
 
-    # Return the cid and name if the search retrieves 1 result and passes string equivalence
-    if int(json.loads(r)['esearchresult']['count']) == 1:
-        if __complex_string_equivalence__(req, name) == True:
-            return cid, name
-        else:
-            return np.nan, np.nan
-
     # Returns cid and name if first result passes the complex equivalence test with the req
-    elif int(json.loads(r)['esearchresult']['count']) > 1:
-        if __complex_string_equivalence__(req, name) == True:
-            return cid, name
+    return __check_search_hit__(req, cid, name)
+
+
+def __compound_search_batch__(reqs, workers=1):
+    """
+        Batch form of the search tier (__compound_search__, through the cache) in three phases. All the
+        searches run first, then the primary names of the distinct top hits are fetched with id_map.cids2names,
+        which POSTs them in batches of 10 to 1000 cids sized to the observed latency (AdaptiveBatchSize), 4
+        batches at a time, and last each hit is checked against its search term
+
+        Input
+        ----------------------------------------------------------------
+        reqs : list
+            cleaned search terms
+        workers : int (default 1)
+            number of concurrent searches
+
+        Returns
+        ----------------------------------------------------------------
+        results : list
+            (pubchem id, pubchem name) tuples in the same order as reqs, (np.nan, np.nan) without caching
+            for terms whose lookup failed on the network
+    """
+    results = {}
+
+    if __cache__ is not None:
+        for req in set(reqs):
+            cached = __cache__.get(req, 'search')
+
+            if cached is not None:
+                results[req] = cached
+
+    pending = [req for req in pd.unique(pd.Series(reqs, dtype=object)) if req not in results]
+
+    # A search that fails on the network gives None instead of raising, so one failing term does not
+    # lose the others
+    def search(req):
+        try:
+            return __esearch_top_cid__(req)
+        except TransportError:
+            __record_failure__()
+            return None
+
+    top_cids = __pool_map__(search, pending, workers)
+
+    hits = sorted({int(cid) for cid in top_cids if cid is not None and not math.isnan(cid)})
+
+    try:
+        synonyms = cids2names(hits, as_dict=True) if len(hits) > 0 else {}
+    except TransportError:
+        # Without names no hit can be checked, so every hit counts as failed
+        for req, cid in zip(pending, top_cids):
+            if cid is not None and not math.isnan(cid):
+                __record_failure__()
+
+        top_cids = [None if cid is not None and not math.isnan(cid) else cid for cid in top_cids]
+        synonyms = {}
+
+    for req, cid in zip(pending, top_cids):
+        if cid is None:
+            # Failed on the network, left unresolved and uncached
+            results[req] = np.nan, np.nan
+            continue
+
+        if math.isnan(cid):
+            result = np.nan, np.nan
         else:
-            return np.nan, np.nan
+            names = synonyms.get(int(cid))
+            name = names[0] if isinstance(names, list) and len(names) > 0 else np.nan
+            result = __check_search_hit__(req, cid, name)
+
+        results[req] = result
+
+        if __cache__ is not None:
+            __cache__.set(req, 'search', *result)
+
+    return [results[req] for req in reqs]
+
+
+# Exact match against the local synonym index, req is cleaned the same way as for __exact_retrevial__
+def __local_exact_retrevial__(req):
+    match = __synonym_index__.get(req.replace('%20', ' '))
+
+    if match is None:
+        return np.nan, np.nan
+
+    return match['cid'], match['label']
 
 
 # try-except wrapper to retrieve pubchem info
 def get_compound_pubchem_info(chem):
-    if __is_nutrient__(chem):
-        return np.nan, np.nan
-        
-    # try:
-    req = __clean_term__(chem, convert_letter=False)
-    compound_id, compound_name = __exact_retrevial__(req)
-    
-    if not math.isnan(compound_id):
-        return compound_id, compound_name
-    # except:
-        # try:
-    req = __clean_term__(chem, convert_letter=False, w_space=False)
-    compound_id, compound_name = __exact_retrevial__(req)
-        # except:
-            # pass
-            # try:
-    if not math.isnan(compound_id):
-        return compound_id, compound_name
+    return __resolve_variants__(
+        __is_nutrient__(chem),
+        __clean_term__(chem, convert_letter=False),
+        __clean_term__(chem, convert_letter=False, w_space=False),
+        __clean_term__(__clean_compound_name__(chem), convert_letter=False)
+    )
+
+
+# Local tier for a whole batch of variants (see normalize_terms), one index lookup per variant column.
+# Returns (cid, primary name) for every term, np.nan where the local index has no match
+def __local_exact_batch__(variants):
+    cids = pd.Series(np.nan, index=variants.index)
+    names = pd.Series(np.nan, index=variants.index, dtype=object)
+
+    for col in ['url', 'no_space']:
+        pending = cids.isnull() & variants[col].notnull() & ~variants.is_nutrient.eq(True)
+        matches = __synonym_index__.lookup(variants.loc[pending, col].str.replace('%20', ' ', regex=False))
+
+        cids[pending] = matches.cid
+        names[pending] = matches.label
+
+    return list(zip(cids, names))
+
+
+# Nutrient, local and exact tiers of __resolve_variants__, searchable is False when the search tiers
+# should not be tried. local is False when the local tier already ran for the term (__local_exact_batch__)
+def __resolve_exact__(is_nutrient, url, no_space, local=True):
+    if is_nutrient:
+        return (np.nan, np.nan), False
+
+    if __synonym_index__ is not None:
+        if local:
+            for req in [url, no_space]:
+                compound_id, compound_name = __local_exact_retrevial__(req)
+
+                if not math.isnan(compound_id):
+                    return (compound_id, compound_name), False
+
+        if __offline__:
+            return (np.nan, np.nan), False
+
+    # A term that fails on the network is left unresolved (and uncached) instead of failing the whole run
+    try:
+        compound_id, compound_name = __cached_lookup__('exact', __exact_retrevial__, url)
+
+        if not math.isnan(compound_id):
+            return (compound_id, compound_name), False
+
+        compound_id, compound_name = __cached_lookup__('exact', __exact_retrevial__, no_space)
+    except TransportError:
+        __record_failure__()
+        return (np.nan, np.nan), False
 
-    req = __clean_term__(chem, convert_letter=False)
-    compound_id, compound_name = __compound_search__(req)
-            # except:
-    
     if not math.isnan(compound_id):
+        return (compound_id, compound_name), False
+
+    return (np.nan, np.nan), True
+
+
+# Runs the resolution tiers over the cleaned variants of a term (see normalize_terms)
+def __resolve_variants__(is_nutrient, url, no_space, compound_url):
+    (compound_id, compound_name), searchable = __resolve_exact__(is_nutrient, url, no_space)
+
+    if not searchable:
         return compound_id, compound_name
 
-    req = __clean_term__(__clean_compound_name__(chem), convert_letter=False)
-    compound_id, compound_name = __compound_search__(req)
+    try:
+        compound_id, compound_name = __cached_lookup__('search', __compound_search__, url)
+
+        if not math.isnan(compound_id):
+            return compound_id, compound_name
+
+        compound_id, compound_name = __cached_lookup__('search', __compound_search__, compound_url)
+    except TransportError:
+        __record_failure__()
+        return np.nan, np.nan
 
     return compound_id, compound_name
 
@@ -311,7 +562,118 @@ def __check_key__(row, id_col, str_col, input_dict):
         return row[id_col]
     
 
-def append_foodb_id(df, chem_key, load_ids=True):
+def build_foodb_index(path=None):
+    """
+        Builds the string-to-id index used by append_foodb_id from the original source strings in foodb
+        (data/contentssql.csv) and the usda nutrient descriptions (data/usda_raw_garlic.csv)
+
+        Input
+        ----------------------------------------------------------------
+        path : str (default None)
+            directory to write the index to, defaults to intermediate_save/foodb_index
+
+        Returns
+        ----------------------------------------------------------------
+        index : StringIndex
+            memory mapped index with a foodb_id column
+    """
+    if path is None:
+        path = __make_fp__('intermediate_save/foodb_index')
+
+    # Dataframe with contents of foodb
+    foodb = pd.read_csv(__make_fp__('data/contentssql.csv'))
+    foodb = foodb[['source_id', 'orig_source_name']].drop_duplicates()
+    foodb.orig_source_name = foodb.orig_source_name.str.strip().str.lower()
+    foodb = foodb.rename(columns={'orig_source_name' : 'name', 'source_id' : 'foodb_id'})
+
+    usda = pd.read_csv(__make_fp__('data/usda_raw_garlic.csv'), encoding = 'latin1')
+    usda.nut_desc = usda.nut_desc.str.strip().str.lower()
+    usda = usda.rename(columns={'nut_desc' : 'name', 'chem_id' : 'foodb_id'})
+
+    # The last occurance of a string within a source wins, and foodb strings win over usda strings
+    sources = [src[['name', 'foodb_id']].drop_duplicates(subset='name', keep='last') for src in [foodb, usda]]
+    strings = pd.concat(sources, ignore_index=True)
+    strings = strings[strings.foodb_id.notnull()]
+
+    build_string_index(path, strings['name'], strings[['foodb_id']], keep='first')
+
+    return StringIndex(path)
+
+
+def build_synonym_index(dump_path, path=None, chunksize=10 ** 6):
+    """
+        Builds the local exact match tier from PubChem's CID-Synonym dump
+        (https://ftp.ncbi.nlm.nih.gov/pubchem/Compound/Extras/CID-Synonym-filtered.gz), which lists the
+        synonyms of each cid in order with the primary name first
+
+        Input
+        ----------------------------------------------------------------
+        dump_path : str
+            location of the tab separated cid / synonym file (may be gzipped)
+        path : str (default None)
+            directory to write the index to, defaults to intermediate_save/synonym_index
+        chunksize : int (default 10 ** 6)
+            lines of the dump to read at once. Synonyms are deduplicated and hashed chunk by chunk, so memory
+            grows by ~16 bytes per distinct synonym of a chunk plus the primary names, not by the synonym strings
+
+        Returns
+        ----------------------------------------------------------------
+        index : StringIndex
+            memory mapped index from lowercase synonym to cid, labeled with the primary compound name
+    """
+    if path is None:
+        path = __make_fp__('intermediate_save/synonym_index')
+
+    reader = pd.read_csv(
+        dump_path, sep='\t', header=None, names=['cid', 'synonym'], dtype={'cid' : np.int64, 'synonym' : str},
+        quoting=csv.QUOTE_NONE, keep_default_na=False, chunksize=chunksize
+    )
+
+    # Only hashes, cids and the encoded primary names are kept between chunks, never the synonyms themselves
+    hashes, cids = [np.zeros(0, dtype=np.uint64)], [np.zeros(0, dtype=np.int64)]
+    primary_cids, primary_blobs = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.uint8)]
+    primary_lengths = [np.zeros(1, dtype=np.int64)] # the leading 0 becomes the first label offset
+    last_cid = None
+
+    for chunk in reader:
+        # The dump is sorted by cid, so the first synonym of each cid is its primary name unless the cid
+        # continues from the previous chunk
+        firsts = chunk.drop_duplicates(subset='cid', keep='first')
+        firsts = firsts[firsts.cid != last_cid]
+        last_cid = chunk.cid.iloc[-1]
+
+        blob, offsets = encode_labels(firsts.synonym)
+        primary_cids.append(firsts.cid.to_numpy())
+        primary_blobs.append(blob)
+        primary_lengths.append(np.diff(offsets))
+
+        synonyms = chunk.synonym.str.strip().str.lower()
+        first = ~synonyms.duplicated().to_numpy()
+        hashes.append(hash_strings(synonyms[first]))
+        cids.append(chunk.cid.to_numpy()[first])
+
+    cids = np.concatenate(cids)
+    offsets = np.cumsum(np.concatenate(primary_lengths))
+
+    # A synonym shared by several compounds resolves to the first (lowest) cid listing it, which is the first
+    # occurrence of its hash that build_hashed_index keeps
+    build_hashed_index(
+        path, np.concatenate(hashes), pd.DataFrame({'cid' : cids}),
+        label_ids=pd.Index(np.concatenate(primary_cids)).get_indexer(cids), label_blob=np.concatenate(primary_blobs),
+        label_offsets=offsets
+    )
+
+    return StringIndex(path)
+
+
+# FooDB compound names indexed for fuzzy matching, only built once per process
+@lru_cache(maxsize=None)
+def __load_foodb_fuzzy_index__(fp):
+    fdb_compounds = pd.read_csv(fp, encoding='latin1')[['id', 'name']].dropna()
+    return FuzzyIndex(fdb_compounds.name.str.strip().str.lower(), ids=fdb_compounds.id, processor=__fuzzy_key__)
+
+
+def append_foodb_id(df, chem_key, load_ids=True, fuzzy=False, threshold=98):
     """
         label chemicals with foodb id where there is a match to chemicals in foodb files under the data directory
 
@@ -322,7 +684,14 @@ def append_foodb_id(df, chem_key, load_ids=True):
         chem_key : str
             column name with the chemical strings
         load_ids : bool (default True)
-            Whether or not to use pre-altered pubchem data. Want to use true after the program has run once to reduce runtime
+            Whether or not to use the prebuilt foodb index (see build_foodb_index). If it has not been built
+            yet (e.g. an install that only has the old .pkl files) it is built and saved on first use, False
+            always rebuilds it
+        fuzzy : bool (default False)
+            fill the remaining ids by fuzzy matching against the foodb compound names, using the same cleaning
+            and fuzz.ratio comparison as the pubchem search tier
+        threshold : float (default 98)
+            minimum fuzz.ratio of a fuzzy match
 
         Returns
         ----------------------------------------------------------------
@@ -358,44 +727,120 @@ def append_foodb_id(df, chem_key, load_ids=True):
 
     # df.foodb_id = df.apply(__check_key__, id_col='foodb_id', str_col=chem_key, input_dict=input_dict, axis=1)
     
-    if load_ids:
-        with open(__make_fp__('intermediate_save/fdb_source_strings.pkl'), 'rb') as f:
-            input_dict = pickle.load(f)
+    index_path = __make_fp__('intermediate_save/foodb_index')
+
+    if load_ids and os.path.exists(f'{index_path}/meta.json'):
+        index = StringIndex(index_path)
     else:
-        # Dataframe with contents of foodb
-        foodb = pd.read_csv(__make_fp__('data/contentssql.csv'))
+        index = build_foodb_index(index_path)
+
+    # Fills the ids that did not match a primary compound name, foodb source strings take priority over
+    # usda descriptions since the index keeps the first source a string appears in
+    matches = index.lookup(df[chem_key])
+    df['foodb_id'] = df['foodb_id'].fillna(matches['foodb_id'])
+
+    if fuzzy:
+        missing = df['foodb_id'].isnull()
+        fuzzy_index = __load_foodb_fuzzy_index__(__make_fp__('data/compounds.csv'))
+        matches = fuzzy_index.match(df.loc[missing, chem_key], threshold=threshold)
+        df.loc[missing, 'foodb_id'] = matches['id'].astype(float)
+                
+    return df
 
-        # Gets the subset of the database pertaining to garlic
-        foodb = foodb[['source_id', 'orig_source_name']].drop_duplicates()
 
-        # Transforms all the chemical names to lowercase for syncing
-        foodb.orig_source_name = foodb.orig_source_name.str.strip().str.lower()
+def __report_dedup__(label, total, unique):
+    ratio = total / unique if unique else 1.
+    print(f'{unique} unique {label} out of {total} ({ratio:.1f}x dedup ratio)')
 
-        # Creates a list of the unique chemicals in garlic from foodb
-        input_dict = {row['orig_source_name'] : row['source_id'] for _, row in foodb.iterrows()}
-        
-        with open(__make_fp__('intermediate_save/fdb_source_strings.pkl'), 'wb') as f:
-            pickle.dump(input_dict, f)
-    
-    df.foodb_id = df.apply(__check_key__, id_col='foodb_id', str_col=chem_key, input_dict=input_dict, axis=1)
-    
-    if load_ids:
-        with open(__make_fp__('intermediate_save/usda_ids.pkl'), 'rb') as f:
-            input_dict = pickle.load(f)
+
+# Maps fn over items on a thread pool of workers threads (serially if workers is 1), keeping the order of items
+def __pool_map__(fn, items, workers=1):
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(fn, items))
+
+    return [fn(item) for item in items]
+
+
+def __resolve_terms__(terms, workers=1):
+    """
+        Resolves a list of chemical strings like get_compound_pubchem_info, keeping up to workers lookups in
+        flight at once. Requests are paced by the transport module, so the pool never goes over the PubChem
+        request ceiling
+
+        The exact tiers run per term, then every term that is still unresolved goes through the batched search
+        tier (__compound_search_batch__), first with the cleaned term and then with the cleaned compound name
+
+        Input
+        ----------------------------------------------------------------
+        terms : pd.Series
+            chemical strings to resolve
+        workers : int (default 1)
+            number of lookups to run concurrently, 1 resolves the terms serially
+
+        Returns
+        ----------------------------------------------------------------
+        results : list
+            (pubchem id, pubchem name) tuples in the same order as terms, terms whose lookup failed on the
+            network are unresolved and the number of failures is reported
+    """
+    global __failed_lookups__
+
+    start = time.time()
+
+    with __failed_lock__:
+        __failed_lookups__ = 0
+
+    # All cleaned variants are computed up front in one batch
+    variants = normalize_terms(terms)
+    exact_variants = list(variants[['is_nutrient', 'url', 'no_space']].itertuples(index=False, name=None))
+
+    # The local tier runs over all terms at once, only the terms it misses go through the per-term tiers
+    local = __local_exact_batch__(variants) if __synonym_index__ is not None else None
+
+    def resolve(i):
+        if local is not None and not math.isnan(local[i][0]):
+            return local[i], False
+
+        return __resolve_exact__(*exact_variants[i], local=local is None)
+
+    if workers > 1:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        resolved = pool.map(resolve, range(len(exact_variants)))
     else:
-        usda = pd.read_csv(__make_fp__('data/usda_raw_garlic.csv'), encoding = 'latin1')
-        usda.nut_desc = usda.nut_desc.str.strip().str.lower()
-        input_dict = {row['nut_desc'] : row['chem_id'] for _, row in usda.iterrows()}
-        
-        with open(__make_fp__('intermediate_save/usda_ids.pkl'), 'wb') as f:
-            pickle.dump(input_dict, f)
-    
-    df.foodb_id = df.apply(__check_key__, id_col='foodb_id', str_col=chem_key, input_dict=input_dict, axis=1)
-                
-    return df
+        pool = None
+        resolved = (resolve(i) for i in range(len(exact_variants)))
+
+    results = []
+    searchable = []
+    for i, (res, search) in enumerate(resolved):
+        results.append(res)
+
+        if search:
+            searchable.append(i)
+
+        if not i % 1000:
+            print(i, 'chems searched in', (time.time() - start) / 60, "min")
+
+    if pool is not None:
+        pool.shutdown()
+
+    for col in ['url', 'compound_url']:
+        pending = [i for i in searchable if math.isnan(results[i][0])]
+        found = __compound_search_batch__(variants[col].iloc[pending].tolist(), workers=workers)
+
+        for i, res in zip(pending, found):
+            results[i] = res
+
+        print(len(pending), 'chems searched by', col, 'in', (time.time() - start) / 60, "min")
+
+    if __failed_lookups__ > 0:
+        print(__failed_lookups__, 'lookups failed on the network and were left unresolved, rerun to retry them')
+
+    return results
 
 
-def append_pubchem_id(df, chem_key):
+def append_pubchem_id(df, chem_key, workers=1):
     """
         label chemicals with pubchem id by searching the pubchem synonyms
 
@@ -404,7 +849,10 @@ def append_pubchem_id(df, chem_key):
         df : pd.DataFrame
             dataframe containing chemical names
         chem_key : str
-            column name with the chemical strings
+            column name with the chemical strings, which are stripped and lowercased before searching so
+            that repeated strings are only resolved once
+        workers : int (default 1)
+            number of concurrent lookups, results are identical to the serial search (workers=1)
 
         Returns
         ----------------------------------------------------------------
@@ -413,35 +861,29 @@ def append_pubchem_id(df, chem_key):
     """
     start = time.time()
 
-    df['pubchem_id'] = np.nan
-    df['pubchem_name'] = np.nan
-
-    df['pubchem_id'] = df['pubchem_id'].astype(object)
-    df['pubchem_name'] = df['pubchem_name'].astype(object)
-
-    i = 0
-    for idx, row in df.iterrows():
-        # get_compound_pubchem_info() creates an error if the chemical does not exist
-        # try:
-        ID, name = get_compound_pubchem_info(row[chem_key])
-        df.at[idx, 'pubchem_id'] = ID
-        df.at[idx, 'pubchem_name'] = name
-            
-        # except:
-            # print(row[chem_key])
-            # pass
-        
-        if not i % 1000:
-            print(idx, 'chems searched in', (time.time() - start) / 60, "min")
+    # Each distinct normalized string is resolved once, rows then take their result by factorized code
+    # (code -1 marks missing strings and picks the trailing nan)
+    codes, terms = pd.factorize(df[chem_key].str.strip().str.lower())
+    __report_dedup__('chemical strings', len(codes), len(terms))
+
+    results = __resolve_terms__(pd.Series(terms), workers=workers)
+
+    ids = np.array([ID for ID, _ in results] + [np.nan], dtype=object)
+    names = np.array([name for _, name in results] + [np.nan], dtype=object)
 
-        i += 1
+    df['pubchem_id'] = pd.Series(ids[codes], index=df.index, dtype=object)
+    df['pubchem_name'] = pd.Series(names[codes], index=df.index, dtype=object)
 
     print("Pubchem ids added in", (time.time() - start) / 60, "min")
 
     return df
 
-def __darkmatter_database__(df, chem_key):
-    dmdb = pd.read_csv(__make_fp__('data/DarkMatter Databases.csv'))
+def __build_darkmatter_lookup__(dmdb):
+    """
+        Indexes the DarkMatter database by chemical string. Strings are matched on the name column first and
+        on the USDA column second, so a USDA string only gets a row if it is not also a name
+    """
+    dmdb = dmdb.copy()
 
     dmdb.name = dmdb.name.str.lower()
     dmdb.USDA = dmdb.USDA.str.lower()
@@ -449,30 +891,53 @@ def __darkmatter_database__(df, chem_key):
     dmdb.Pubchem = dmdb.Pubchem.replace('0', np.nan)
     dmdb['FooDB ID'] = dmdb['FooDB ID'].replace('0', np.nan)
 
-    for idx, row in df.iterrows():
-        if np.isnan(row['pubchem_id']):
-            if row[chem_key] in dmdb['name'].tolist():
-                df.at[idx, 'pubchem_id'] = float(dmdb[dmdb['name'] == row[chem_key]].Pubchem.tolist()[0])
-                df.at[idx, 'inchikey'] = dmdb[dmdb['name'] == row[chem_key]].start.tolist()[0]
-                df.at[idx, 'foodb_id'] = float(dmdb[dmdb['name'] == row[chem_key]]['FooDB ID'].tolist()[0])
+    dmdb = dmdb.rename(columns={'Pubchem' : 'pubchem_id', 'start' : 'inchikey', 'FooDB ID' : 'foodb_id'})
+    dmdb.pubchem_id = dmdb.pubchem_id.astype(float)
+    dmdb.foodb_id = dmdb.foodb_id.astype(float)
+
+    tables = []
+    for key in ['name', 'USDA']:
+        table = dmdb[dmdb[key].notnull()].drop_duplicates(subset=key, keep='first')
+        tables.append(table.set_index(key)[['pubchem_id', 'inchikey', 'foodb_id']])
+
+    lookup = pd.concat(tables)
+
+    return lookup[~lookup.index.duplicated(keep='first')]
+
+
+# DarkMatter lookup is only read and indexed once per process
+@lru_cache(maxsize=None)
+def __load_darkmatter_lookup__(fp):
+    return __build_darkmatter_lookup__(pd.read_csv(fp))
+
+
+def __darkmatter_database__(df, chem_key, lookup=None):
+    if lookup is None:
+        lookup = __load_darkmatter_lookup__(__make_fp__('data/DarkMatter Databases.csv'))
+
+    matched = df[chem_key].isin(lookup.index)
+    matches = lookup.reindex(df[chem_key])
+    matches.index = df.index
+
+    # Rows without a pubchem id take all three ids, rows with one only fill a missing foodb id
+    no_pubchem = matched & df.pubchem_id.isnull()
+    no_foodb = matched & df.pubchem_id.notnull() & df.foodb_id.isnull()
+
+    if 'inchikey' not in df:
+        df['inchikey'] = np.nan
 
-            elif row[chem_key] in dmdb['USDA'].tolist():
-                df.at[idx, 'pubchem_id'] = float(dmdb[dmdb['USDA'] == row[chem_key]].Pubchem.tolist()[0])
-                df.at[idx, 'inchikey'] = dmdb[dmdb['USDA'] == row[chem_key]].start.tolist()[0]
-                df.at[idx, 'foodb_id'] = float(dmdb[dmdb['USDA'] == row[chem_key]]['FooDB ID'].tolist()[0])
+    df['inchikey'] = df['inchikey'].astype(object)
 
-        elif np.isnan(row['foodb_id']):
-            if row[chem_key] in dmdb['name'].tolist():
-                df.at[idx, 'foodb_id'] = float(dmdb[dmdb['name'] == row[chem_key]]['FooDB ID'].tolist()[0])
+    for col in ['pubchem_id', 'inchikey', 'foodb_id']:
+        df.loc[no_pubchem, col] = matches.loc[no_pubchem, col]
 
-            elif row[chem_key] in dmdb['USDA'].tolist():
-                df.at[idx, 'foodb_id'] = float(dmdb[dmdb['USDA'] == row[chem_key]]['FooDB ID'].tolist()[0])
+    df.loc[no_foodb, 'foodb_id'] = matches.loc[no_foodb, 'foodb_id']
 
     return df
 
 
 
-def id_searcher(df, chem_key, fdb = True, pubchem = True, use_prefix=True):
+def id_searcher(df, chem_key, fdb = True, pubchem = True, use_prefix=True, workers=1):
     """
         main function to assign chemical keys in pubchem and foodb
 
@@ -489,14 +954,17 @@ def id_searcher(df, chem_key, fdb = True, pubchem = True, use_prefix=True):
         use_prefix : bool (default True)
             only return the prefix of inchikeys (before the first -), which contains the structural information
             (to find out more see https://www.inchi-trust.org/technical-faq-2/)
+        workers : int (default 1)
+            number of concurrent pubchem lookups (see append_pubchem_id)
 
         Returns
         ----------------------------------------------------------------
         df : pd.DataFrame
-            input dataframe with a pubchem_id + foodb_id columns, and composite column chem_id
+            input dataframe with a pubchem_id + foodb_id columns, and composite column chem_id (pandas string
+            dtype, the InChIKey or the offset foodb id as an integer string, <NA> if neither is found)
     """
     if pubchem:
-        df = append_pubchem_id(df, chem_key)
+        df = append_pubchem_id(df, chem_key, workers=workers)
         print(len(df))
     if fdb:
         df = append_foodb_id(df, chem_key)
@@ -510,24 +978,27 @@ def id_searcher(df, chem_key, fdb = True, pubchem = True, use_prefix=True):
     # num_covered = len(df[df.foodb_id.notnull()].foodb_id.drop_duplicates())
     # print('FooDB unique compound coverage', num_covered / total, '%')
 
-    df.at[df[df.pubchem_id.notnull()].index, 'inchikey'] = cids2inchis(df[df.pubchem_id.notnull()].pubchem_id.tolist(), use_prefix=use_prefix)
+    # InChIKeys are requested once per distinct cid and broadcast back to the rows
+    cids = df.pubchem_id.dropna().unique()
+    __report_dedup__('pubchem ids', df.pubchem_id.notnull().sum(), len(cids))
+
+    if len(cids) > 0:
+        inchikeys = dict(zip(cids, cids2inchis(cids.tolist(), use_prefix=use_prefix)))
+    else:
+        inchikeys = {}
+
+    df['inchikey'] = df.pubchem_id.map(inchikeys)
     
     df = __darkmatter_database__(df, chem_key)
 
     # Manually looked up the maximum pubchem index to make sure id's don't overlap
     max_p_index = 134825000
 
-    # Ensure that column type is object
-    df['chem_id'] = np.nan
-    df['chem_id'] = df['chem_id'].astype(object)
-    
-    # If there is no pubchem_id, make chem_id the foodb_id + the maximum pubchem id
-    for idx, row in df.iterrows():
-        # if not math.isnan(row['inchikey']):
-        if isinstance(row['inchikey'], str):
-            df.at[idx, 'chem_id'] = row['inchikey']
-        else:
-            df.at[idx, 'chem_id'] = row['foodb_id'] + max_p_index
+    # chem_id is a string column holding the InChIKey where there is one, otherwise the foodb_id + the
+    # maximum pubchem id written as an integer (e.g. '134825123'), <NA> if there is no foodb_id either
+    df['inchikey'] = df['inchikey'].astype(object)
+    foodb_keys = (df['foodb_id'].astype(float) + max_p_index).astype('Int64').astype('string')
+    df['chem_id'] = df['inchikey'].astype('string').fillna(foodb_keys)
     
     # num_covered = len(df[df.chem_id.notnull()].chem_id.drop_duplicates())
     # print('Total unique compound covereage', num_covered / total, '%')
@@ -535,4 +1006,86 @@ def id_searcher(df, chem_key, fdb = True, pubchem = True, use_prefix=True):
     # file = 'intermediate_save/' + file
     # df.to_pickle(file)
     
-    return df
\ No newline at end of file
+    return df
+
+
+def __write_checkpoint__(fp, state):
+    # Written to a temporary file and renamed, so a crash never leaves a partial checkpoint
+    with open(fp + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(fp + '.tmp', fp)
+
+
+def id_searcher_stream(input_fp, output_fp, chem_key, chunksize=100000, checkpoint_fp=None, **kwargs):
+    """
+        Runs id_searcher over a csv that is too large to load at once. The input is read in chunks, every
+        chunk goes through all labeling stages and is appended to the output csv, so memory stays bounded by
+        the chunk size. A checkpoint is written after every chunk, and rerunning with the same arguments after
+        a crash resumes from the last finished chunk. Resuming skips finished rows by line number, so it assumes
+        one line per row and is not reliable for inputs with quoted multi-line fields
+
+        Input
+        ----------------------------------------------------------------
+        input_fp : str
+            csv with a column of chemical strings
+        output_fp : str
+            csv to write the labeled rows to
+        chem_key : str
+            column name with the chemical strings
+        chunksize : int (default 100000)
+            rows labeled at once
+        checkpoint_fp : str (default None)
+            location of the checkpoint, defaults to output_fp + '.checkpoint'. Removed once the run finishes
+        **kwargs
+            passed on to id_searcher (fdb, pubchem, use_prefix, workers)
+
+        Returns
+        ----------------------------------------------------------------
+        rows : int
+            number of rows written to output_fp
+    """
+    start = time.time()
+
+    if checkpoint_fp is None:
+        checkpoint_fp = output_fp + '.checkpoint'
+
+    state = {'input' : input_fp, 'chunksize' : chunksize, 'chunks' : 0, 'input_rows' : 0, 'rows' : 0, 'bytes' : 0}
+
+    if os.path.exists(checkpoint_fp):
+        with open(checkpoint_fp) as f:
+            saved = json.load(f)
+
+        if saved['input'] != input_fp or saved['chunksize'] != chunksize:
+            raise ValueError(f'{checkpoint_fp} was written for a different input or chunksize')
+
+        state = saved
+        print('Resuming after', state['chunks'], 'chunks (', state['input_rows'], 'rows )')
+
+    # Anything written after the last checkpoint belongs to an unfinished chunk
+    with open(output_fp, 'a') as f:
+        f.truncate(state['bytes'])
+
+    # A callable, since a range of every finished row would be materialized by pandas on a large resume
+    done = state['input_rows']
+    reader = pd.read_csv(input_fp, chunksize=chunksize, skiprows=lambda i: 0 < i <= done)
+
+    for chunk in reader:
+        input_rows = len(chunk)
+        chunk = id_searcher(chunk.reset_index(drop=True), chem_key, **kwargs)
+
+        with open(output_fp, 'a') as f:
+            chunk.to_csv(f, header=state['bytes'] == 0, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+            state['bytes'] = f.tell()
+
+        state['chunks'] += 1
+        state['input_rows'] += input_rows
+        state['rows'] += len(chunk)
+        __write_checkpoint__(checkpoint_fp, state)
+
+        print(state['chunks'], 'chunks labeled in', (time.time() - start) / 60, "min")
+
+    os.remove(checkpoint_fp)
+
+    return state['rows']
@@ -3,62 +3,288 @@ Author: Jiali Cheng
 
 Purpose: Replace MeshID with CID / SID
 
-Use case: check the main function
+Rank 0 hands out MeSH IDs to the other ranks one chunk at a time, so a rank stuck on slow responses does not
+hold up the rest, gathers their results and writes them to a single csv. Finished lookups are checkpointed
+periodically, and rerunning the same command resumes from the checkpoint. Without mpi4py (or with a single
+rank) the lookups run in a local multiprocessing pool instead
+
+Requests go through chemidr.transport, and every worker process gets an equal share of the host's request
+ceiling (--rate), so the run as a whole stays under it however many workers there are
+
+Use case:
+    mpirun -n 16 python mesh2cid.py --path mesh2cid.csv
+    python mesh2cid.py --path mesh2cid.csv --mesh-index mesh_index # only searches MeSH ids missing from the crosswalk
+    python mesh2cid.py --path mesh2cid.csv --processes 8
+    python mesh2cid.py --input meshes.csv --path out.csv --base-url http://localhost:8000 # against a stub server
+    python -m chemidr.mesh2cid --path mesh2cid.csv # same as running the file, from the directory above chemidr
 '''
 
 PREFIX = '/scratch/cheng.jial/foodome'
 import pandas as pd
-import pickle
-import requests
 from lxml import etree
-import requests
-import mpi4py.MPI as MPI
 import argparse
+import json
+import os
+import sys
+import time
+from functools import partial
+from multiprocessing import Pool
+from urllib.parse import urlparse
+
+# Run as a script (python mesh2cid.py, also under mpirun), the chemidr package is found next to this file
+if __package__ in (None, ''):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chemidr.transport import TransportError, safe_urlopen, set_rate_limit
+
+try:
+    import mpi4py.MPI as MPI
+except ImportError:
+    MPI = None
+
+
+BASE_URL = 'http://www.ncbi.nlm.nih.gov'
+RATE = 3 # requests per second allowed by NCBI without an api key, shared by all workers
+
+# MPI message tags
+__TASK__ = 1
+__RESULT__ = 2
+
 
-def mesh2cid(mesh):
+def __crosswalk_record__(mesh, sid, cid):
+    if pd.notnull(cid):
+        return {'mesh': mesh, 'tag': 'compound', 'value': str(int(cid))}
+
+    return {'mesh': mesh, 'tag': 'substance', 'value': str(int(sid))}
+
+
+def crosswalk(meshes, index):
+    '''
+    Looks up meshes in a local crosswalk (see chemidr.id_map.build_mesh_index), returns a dict of mesh to
+    result (as mesh2cid) for the meshes that are indexed
+    '''
+    meshes = list(meshes)
+    local = index.lookup([str(m).strip() for m in meshes])
+    found = local.sid.notnull().to_numpy()
+
+    return {
+        m : __crosswalk_record__(m, sid, cid)
+        for m, sid, cid in zip(pd.Series(meshes)[found], local.sid[found], local.cid[found])
+    }
+
+
+def mesh2cid(mesh, base_url=BASE_URL, index=None):
     '''
     Look up the chemical CID/SID based on the Mesh ID
     Input
     ----------------------------------------------------------------
     mesh : str
         Mesh ID of the chemical
+    base_url : str (default BASE_URL)
+        scheme and host of the substance search
+    index : StringIndex (default None)
+        local crosswalk checked before searching (see chemidr.id_map.build_mesh_index)
 
     Returns
     ----------------------------------------------------------------
-    output : dict
-        dictionary of Mesh ID, 
-        tag (whether it's CID or SID) and 
-        value (CID value or SID value)
+    output : dict or None
+        dictionary of Mesh ID,
+        tag (whether it's CID or SID) and
+        value (CID value or SID value), both None if the search has no single match.
+        None if the request failed, so the lookup is retried on a rerun
     '''
+    if index is not None:
+        local = crosswalk([mesh], index)
+
+        if mesh in local:
+            return local[mesh]
+
+    url = '{}/pcsubstance?term=%22{}%22%5bSourceID%5d'.format(base_url.rstrip('/'), mesh)
+
     try:
-        url = 'http://www.ncbi.nlm.nih.gov/pcsubstance?term=%22{}%22%5bSourceID%5d'.format(mesh)
-        response = requests.get(url).text
-        html = etree.HTML(response)
+        content = safe_urlopen(url)
+    except TransportError:
+        return None
+
+    try:
+        html = etree.HTML(content)
         element = html[0].find("meta[@property='og:url']")
         info = element.get('content').split('/')
-        tag = info[-2]
-        value = info[-1]
-        return {'mesh': mesh, 'tag': tag, 'value': value}
-    except:
-        return "None"
+        return {'mesh': mesh, 'tag': info[-2], 'value': info[-1]}
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return {'mesh': mesh, 'tag': None, 'value': None}
+
+
+def share_rate_limit(base_url, rate, workers):
+    '''
+    Sets the request ceiling of this process to its share of rate, so workers processes together make no more
+    than rate requests per second to the host of base_url
+    '''
+    set_rate_limit(urlparse(base_url).netloc, rate / max(workers, 1))
+
+
+def __mesh2cid_chunk__(meshes, base_url=BASE_URL):
+    return [r for r in (mesh2cid(m, base_url=base_url) for m in meshes) if r is not None]
+
+
+def load_checkpoint(fp):
+    '''
+    Returns the finished lookups of a checkpoint as a dict of mesh to result, empty if there is none
+    '''
+    if fp is None or not os.path.exists(fp):
+        return {}
+
+    with open(fp) as f:
+        return {r['mesh'] : r for r in json.load(f)}
+
+
+def __write_checkpoint__(fp, results):
+    # Written to a temporary file and renamed, so a crash never leaves a partial checkpoint
+    with open(fp + '.tmp', 'w') as f:
+        json.dump(list(results.values()), f)
+    os.replace(fp + '.tmp', fp)
+
+
+def __chunks__(meshes, chunksize):
+    return [meshes[i : i + chunksize] for i in range(0, len(meshes), chunksize)]
+
+
+class __Progress__:
+    '''
+    Collects results, and writes a checkpoint every checkpoint_every new results
+    '''
+    def __init__(self, results, checkpoint_fp, checkpoint_every):
+        self.results = results
+        self.checkpoint_fp = checkpoint_fp
+        self.checkpoint_every = checkpoint_every
+        self.new = 0
+
+    def add(self, results):
+        for r in results:
+            self.results[r['mesh']] = r
+
+        self.new += len(results)
+
+        if self.checkpoint_fp is not None and self.new >= self.checkpoint_every:
+            __write_checkpoint__(self.checkpoint_fp, self.results)
+            self.new = 0
+
+
+def run_mpi(comm, meshes, progress, chunksize=1, base_url=BASE_URL, rate=RATE):
+    '''
+    Rank 0 sends chunks of meshes to whichever rank asks for work next and collects the results until
+    every rank has been told to stop. The other ranks request work, look it up and send back the results,
+    each at no more than its share of rate requests per second
+    '''
+    if comm.Get_rank() != 0:
+        share_rate_limit(base_url, rate, comm.Get_size() - 1)
+        comm.send([], dest=0, tag=__RESULT__)
+
+        while True:
+            chunk = comm.recv(source=0, tag=__TASK__)
+
+            if chunk is None:
+                return
+
+            comm.send(__mesh2cid_chunk__(chunk, base_url=base_url), dest=0, tag=__RESULT__)
+
+    queue = __chunks__(list(meshes), chunksize)
+    queue.reverse()
+    active = comm.Get_size() - 1
+    status = MPI.Status()
+
+    while active > 0:
+        results = comm.recv(source=MPI.ANY_SOURCE, tag=__RESULT__, status=status)
+        progress.add(results)
+
+        if queue:
+            comm.send(queue.pop(), dest=status.Get_source(), tag=__TASK__)
+        else:
+            comm.send(None, dest=status.Get_source(), tag=__TASK__)
+            active -= 1
+
+
+def run_local(meshes, progress, processes=None, chunksize=1, base_url=BASE_URL, rate=RATE):
+    '''
+    Looks up meshes in a multiprocessing pool, chunks are handed out as workers become free. Each worker
+    makes no more than its share of rate requests per second
+    '''
+    processes = processes if processes is not None else os.cpu_count()
+
+    with Pool(processes, initializer=share_rate_limit, initargs=(base_url, rate, processes)) as pool:
+        for results in pool.imap_unordered(
+            partial(__mesh2cid_chunk__, base_url=base_url), __chunks__(list(meshes), chunksize)
+        ):
+            progress.add(results)
 
 
 if __name__ == "__main__":
 
-    comm = MPI.COMM_WORLD
-    comm_rank = comm.Get_rank()
-    comm_size = comm.Get_size()
-    
     # Parse arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('--path', dest='PATH', type=str, help='path of the result')
+    parser.add_argument('--input', dest='input', type=str, default='%s/data/pubmed-chemical-disease.csv'%PREFIX,
+                        help='csv with a column of mesh ids')
+    parser.add_argument('--column', dest='column', type=str, default='ChemicalID', help='column of mesh ids')
+    parser.add_argument('--checkpoint', dest='checkpoint', type=str, default=None,
+                        help='checkpoint file (default: path of the result + .checkpoint.json)')
+    parser.add_argument('--checkpoint-every', dest='checkpoint_every', type=int, default=500,
+                        help='results between checkpoints')
+    parser.add_argument('--chunksize', dest='chunksize', type=int, default=1, help='mesh ids handed out at once')
+    parser.add_argument('--processes', dest='processes', type=int, default=None,
+                        help='pool size when running without MPI (default: number of cores)')
+    parser.add_argument('--base-url', dest='base_url', type=str, default=BASE_URL, help='scheme and host of the search')
+    parser.add_argument('--rate', dest='rate', type=float, default=RATE,
+                        help='requests per second to the search host, shared by all workers')
+    parser.add_argument('--mesh-index', dest='mesh_index', type=str, default=None,
+                        help='local crosswalk directory (chemidr.id_map.build_mesh_index), only misses are searched')
     parser.set_defaults(flag=False)
     args = parser.parse_args()
 
-    cd = pd.read_csv('%s/data/pubmed-chemical-disease.csv'%PREFIX)
-    mesh_list = cd.ChemicalID.drop_duplicates().values
+    comm = MPI.COMM_WORLD if MPI is not None else None
+    comm_rank = comm.Get_rank() if comm is not None else 0
+    comm_size = comm.Get_size() if comm is not None else 1
+
+    checkpoint_fp = args.checkpoint if args.checkpoint is not None else args.PATH + '.checkpoint.json'
+
+    if comm_rank == 0:
+        start = time.time()
+
+        cd = pd.read_csv(args.input)
+        mesh_list = cd[args.column].dropna().drop_duplicates().values
+
+        results = load_checkpoint(checkpoint_fp)
+        todo = [m for m in mesh_list if m not in results]
+        print(len(results), 'mesh ids restored from checkpoint')
+
+        if args.mesh_index is not None:
+            from chemidr.index import StringIndex
+
+            local = crosswalk(todo, StringIndex(args.mesh_index))
+            results.update(local)
+            todo = [m for m in todo if m not in local]
+            print(len(local), 'mesh ids found in the crosswalk')
+
+        print(len(todo), 'to look up on', max(comm_size - 1, 1), 'workers')
+
+        progress = __Progress__(results, checkpoint_fp, args.checkpoint_every)
+    else:
+        todo, progress = None, None
+
+    if comm_size > 1:
+        run_mpi(comm, todo, progress, chunksize=args.chunksize, base_url=args.base_url, rate=args.rate)
+    else:
+        run_local(
+            todo, progress, processes=args.processes, chunksize=args.chunksize, base_url=args.base_url,
+            rate=args.rate
+        )
+
+    if comm_rank == 0:
+        __write_checkpoint__(checkpoint_fp, progress.results)
+
+        output = pd.DataFrame(
+            [progress.results[m] for m in mesh_list if m in progress.results], columns=['mesh', 'tag', 'value']
+        )
+        output.to_csv(args.PATH, index=False)
 
-    size = len(mesh_list) / comm_size
-    local_mesh_list = mesh_list[comm_rank*size : comm_rank*size + size]
-    local_result = [mesh2cid(i) for i in local_mesh_list]
-    
\ No newline at end of file
+        print(len(output), 'of', len(mesh_list), 'mesh ids looked up in', (time.time() - start) / 60, 'min')
@@ -0,0 +1,423 @@
+"""
+    Purpose: Tanimoto similarity search over compound libraries, for deduplicating and clustering large sets of
+    chemicals
+
+    Morgan fingerprints (see chem_embedding) are stored as packed bits, 64 to a uint64 word, so a 2048 bit
+    fingerprint is 256 bytes. Similarities are computed a block of queries against a block of the library at a
+    time: the words of both are ANDed and popcounted word by word, which keeps the temporary arrays at
+    block x block regardless of the fingerprint length
+
+    Example Usage:
+        library = FingerprintLibrary.from_smiles(['CCO', 'CCCO', 'c1ccccc1O'], ids=[702, 1031, 996])
+        library.search(['CCN'], k=2, threshold=.3)
+        library.all_pairs(threshold=.7, processes=8)
+"""
+
+import json
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from rdkit import Chem
+from rdkit.Chem import rdFingerprintGenerator
+
+from .chem_embedding import __map_smiles__
+
+
+if hasattr(np, 'bitwise_count'):
+    __popcount__ = np.bitwise_count
+else:
+    __BYTE_COUNTS__ = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    # Counts the bits of every byte, words may be a strided view (e.g. a column of fingerprints)
+    def __popcount__(words, out=None):
+        counts = __BYTE_COUNTS__[np.ascontiguousarray(words).view(np.uint8)]
+        return counts.reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8, out=out)
+
+
+def __packed_fingerprint__(SMILE, radius=2, n_bits=2048):
+    mol = Chem.MolFromSmiles(SMILE) if isinstance(SMILE, str) else None
+
+    if mol is None:
+        return None
+
+    bits = rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=n_bits).GetFingerprintAsNumPy(mol)
+
+    return np.packbits(bits.astype(bool))
+
+
+def pack_fingerprints(SMILES, radius=2, n_bits=2048, processes=None, chunksize=500):
+    """
+        Morgan bit fingerprints of many SMILES, computed in a process pool
+
+        Input
+        ----------------------------------------------------------------
+        SMILES : iterable
+            SMILE strings
+        radius : int (default 2)
+            Morgan fingerprint radius
+        n_bits : int (default 2048)
+            fingerprint length, a multiple of 64
+        processes : int (default None)
+            number of worker processes, defaults to the number of cores. 1 runs in the calling process
+        chunksize : int (default 500)
+            SMILES sent to a worker at once
+
+        Returns
+        ----------------------------------------------------------------
+        fingerprints : np.ndarray
+            (molecules x n_bits / 64) uint64 packed fingerprints, all zero for SMILES that could not be parsed
+        failed : np.ndarray
+            True for every SMILE that could not be parsed
+    """
+    if n_bits % 64 != 0:
+        raise ValueError(f'n_bits must be a multiple of 64, got {n_bits}')
+
+    fingerprint = partial(__packed_fingerprint__, radius=radius, n_bits=n_bits)
+    rows = list(__map_smiles__(fingerprint, SMILES, processes, chunksize))
+
+    failed = np.array([row is None for row in rows], dtype=bool)
+    packed = np.zeros((len(rows), n_bits // 8), dtype=np.uint8)
+
+    for i, row in enumerate(rows):
+        if row is not None:
+            packed[i] = row
+
+    return packed.view(np.uint64), failed
+
+
+def bit_counts(fingerprints):
+    """
+        Number of set bits of every packed fingerprint
+    """
+    fingerprints = np.atleast_2d(fingerprints)
+    counts = np.zeros(len(fingerprints), dtype=np.int32)
+
+    for w in range(fingerprints.shape[1]):
+        counts += __popcount__(fingerprints[:, w])
+
+    return counts
+
+
+def tanimoto(queries, library, query_counts=None, library_counts=None):
+    """
+        Tanimoto similarity of every query against every library fingerprint
+
+        Input
+        ----------------------------------------------------------------
+        queries : np.ndarray
+            packed fingerprints, one query may be passed as a single row
+        library : np.ndarray
+            packed fingerprints
+        query_counts, library_counts : np.ndarray (default None)
+            precomputed bit_counts of queries and library
+
+        Returns
+        ----------------------------------------------------------------
+        similarities : np.ndarray
+            (queries x library) float32 similarities. Two empty fingerprints have a similarity of 0
+    """
+    queries, library = np.atleast_2d(queries), np.atleast_2d(library)
+    query_counts = bit_counts(queries) if query_counts is None else query_counts
+    library_counts = bit_counts(library) if library_counts is None else library_counts
+
+    # Word-major copies so every step of the loop reads contiguous memory, and preallocated temporaries
+    queries_t, library_t = np.ascontiguousarray(queries.T), np.ascontiguousarray(library.T)
+    words = np.empty((len(queries), len(library)), dtype=np.uint64)
+    word_counts = np.empty((len(queries), len(library)), dtype=np.uint8)
+    shared = np.zeros((len(queries), len(library)), dtype=np.uint16)
+
+    for w in range(len(queries_t)):
+        np.bitwise_and(queries_t[w][:, None], library_t[w][None, :], out=words)
+        shared += __popcount__(words, out=word_counts)
+
+    shared = shared.astype(np.int32)
+    union = query_counts[:, None] + library_counts[None, :] - shared
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        similarities = np.where(union > 0, shared / union, 0)
+
+    return similarities.astype(np.float32)
+
+
+# Orders flat (row, column, similarity) hits by row and decreasing similarity, keeping the first k of every row
+# when k is given
+def __top_k__(rows, columns, values, k=None):
+    order = np.lexsort((columns, -values, rows))
+    rows, columns, values = rows[order], columns[order], values[order]
+
+    if k is not None:
+        keep = np.arange(len(rows)) - np.searchsorted(rows, rows) < k
+        rows, columns, values = rows[keep], columns[keep], values[keep]
+
+    return rows, columns, values
+
+
+# Top k (or all if k is None) hits of every row of a block of similarities that pass the threshold
+def __block_hits__(similarities, threshold, k=None):
+    if k is not None and k < similarities.shape[1]:
+        columns = np.argpartition(-similarities, k - 1, axis=1)[:, :k].ravel()
+        rows = np.repeat(np.arange(len(similarities)), k)
+    else:
+        rows, columns = np.indices(similarities.shape).reshape(2, -1)
+
+    values = similarities[rows, columns]
+    keep = values >= threshold
+
+    return __top_k__(rows[keep], columns[keep], values[keep], k)
+
+
+# Hits of the rows start:stop of queries against the columns from first on of library, merged over blocks of
+# columns. exclude_self drops the similarity of a library row with itself (when queries is the library), and
+# fingerprints marked in query_failed / library_failed never match
+def __search_block__(queries, query_counts, library, library_counts, start, stop, threshold, k, block_size,
+                     first=0, exclude_self=False, query_failed=None, library_failed=None):
+    found_q, found_c, found_s = [], [], []
+
+    row_counts = query_counts[start:stop]
+
+    for col in range(first, len(library), block_size):
+        col_stop = min(col + block_size, len(library))
+
+        # Tanimoto is at most min(a, b) / max(a, b) of the bit counts, so a block whose counts are all too far
+        # from the row counts can not pass the threshold. Skips most blocks when the library is sorted by count
+        if threshold > 0 and len(row_counts) > 0:
+            col_counts = library_counts[col:col_stop]
+            if col_counts.max() < threshold * row_counts.min() or threshold * col_counts.min() > row_counts.max():
+                continue
+
+        sims = tanimoto(queries[start:stop], library[col:col_stop], query_counts[start:stop], library_counts[col:col_stop])
+
+        if exclude_self:
+            rows = np.arange(start, stop)
+            own = (rows >= col) & (rows < col_stop)
+            sims[own.nonzero()[0], rows[own] - col] = -np.inf
+
+        if query_failed is not None:
+            sims[query_failed[start:stop]] = -np.inf
+        if library_failed is not None:
+            sims[:, library_failed[col:col_stop]] = -np.inf
+
+        qi, ci, s = __block_hits__(sims, threshold, k)
+
+        found_q.append(qi + start)
+        found_c.append(ci + col)
+        found_s.append(s)
+
+    if len(found_q) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    return __top_k__(np.concatenate(found_q), np.concatenate(found_c), np.concatenate(found_s), k)
+
+
+# Library shared with the all_pairs worker processes
+__library__ = None
+
+
+def __init_worker__(fingerprints, counts, failed):
+    global __library__
+
+    __library__ = (fingerprints, counts, failed)
+
+
+# Hits of library rows start:stop against the rest of the library. Without k only pairs with a later row are
+# kept, so every pair is found once
+def __all_pairs_block__(bounds, threshold, k, block_size):
+    start, stop = bounds
+    fingerprints, counts, failed = __library__
+
+    if k is not None:
+        return __search_block__(
+            fingerprints, counts, fingerprints, counts, start, stop, threshold, k, block_size, exclude_self=True,
+            query_failed=failed, library_failed=failed
+        )
+
+    # The rows of the block are compared with each other, then with every later block
+    sims = tanimoto(fingerprints[start:stop], fingerprints[start:stop], counts[start:stop], counts[start:stop])
+    sims[np.tril_indices(stop - start)] = -np.inf
+    sims[failed[start:stop]] = -np.inf
+    sims[:, failed[start:stop]] = -np.inf
+    qi, ci, s = __block_hits__(sims, threshold)
+
+    later = __search_block__(
+        fingerprints, counts, fingerprints, counts, start, stop, threshold, None, block_size, first=stop,
+        query_failed=failed, library_failed=failed
+    )
+
+    return __top_k__(np.concatenate([qi + start, later[0]]), np.concatenate([ci + start, later[1]]), np.concatenate([s, later[2]]))
+
+
+class FingerprintLibrary:
+    """
+        Input
+        ----------------------------------------------------------------
+        fingerprints : np.ndarray
+            packed fingerprints (see pack_fingerprints)
+        ids : list (default None)
+            id of each fingerprint, defaults to its position
+        radius : int (default 2)
+            Morgan radius of the fingerprints, used to fingerprint SMILES queries
+    """
+    def __init__(self, fingerprints, ids=None, radius=2):
+        self.radius = radius
+        self.fingerprints = np.atleast_2d(fingerprints)
+        self.ids = np.arange(len(self.fingerprints)) if ids is None else np.asarray(ids)
+        self.counts = bit_counts(self.fingerprints)
+        self.failed = np.zeros(len(self.fingerprints), dtype=bool)
+
+    @classmethod
+    def from_smiles(cls, SMILES, ids=None, radius=2, n_bits=2048, processes=None):
+        """
+            Fingerprints SMILES (see pack_fingerprints), SMILES that could not be parsed are marked in failed
+            and are never returned by search or all_pairs
+        """
+        fingerprints, failed = pack_fingerprints(SMILES, radius=radius, n_bits=n_bits, processes=processes)
+
+        library = cls(fingerprints, ids=ids, radius=radius)
+        library.failed = failed
+
+        return library
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def save(self, path):
+        """
+            Writes the library to a directory, reload it with FingerprintLibrary.load
+        """
+        os.makedirs(path, exist_ok=True)
+
+        np.save(f'{path}/fingerprints.npy', self.fingerprints)
+        np.save(f'{path}/ids.npy', self.ids, allow_pickle=self.ids.dtype == object)
+        np.save(f'{path}/failed.npy', self.failed)
+
+        with open(f'{path}/meta.json', 'w') as f:
+            json.dump({'radius' : self.radius}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+            Loads a library written by save, with the fingerprints memory mapped read-only by default
+        """
+        fingerprints = np.load(f'{path}/fingerprints.npy', mmap_mode='r' if mmap else None)
+        ids = np.load(f'{path}/ids.npy', allow_pickle=True)
+
+        with open(f'{path}/meta.json') as f:
+            meta = json.load(f)
+
+        library = cls(fingerprints, ids=ids, radius=meta['radius'])
+        library.failed = np.load(f'{path}/failed.npy')
+
+        return library
+
+    # Packed fingerprints of queries and which of them could not be parsed (none for packed queries)
+    def __queries__(self, queries):
+        if isinstance(queries, np.ndarray) and queries.dtype == np.uint64:
+            queries = np.atleast_2d(queries)
+            return queries, np.zeros(len(queries), dtype=bool)
+
+        n_bits = self.fingerprints.shape[1] * 64
+
+        return pack_fingerprints(queries, radius=self.radius, n_bits=n_bits, processes=1)
+
+    def similarity(self, queries):
+        """
+            Tanimoto similarity of queries (SMILES or packed fingerprints) against the whole library, as a
+            (queries x library) float32 matrix
+        """
+        queries, _ = self.__queries__(queries)
+
+        return tanimoto(queries, self.fingerprints, library_counts=self.counts)
+
+    def search(self, queries, k=10, threshold=0., block_size=1024):
+        """
+            Finds the most similar library compounds of every query
+
+            Input
+            ----------------------------------------------------------------
+            queries : list or np.ndarray
+                SMILES or packed fingerprints
+            k : int or None (default 10)
+                neighbors kept per query, all that pass the threshold if None. Ties with the k-th neighbor are
+                broken arbitrarily
+            threshold : float (default 0.)
+                minimum Tanimoto similarity of a neighbor
+            block_size : int (default 1024)
+                queries (and library compounds) compared at once
+
+            Returns
+            ----------------------------------------------------------------
+            neighbors : pd.DataFrame
+                one row per neighbor with the position of the 'query', the library 'id' and the 'similarity',
+                ordered by query and decreasing similarity. Queries and library compounds that could not be
+                parsed have no neighbors
+        """
+        queries, query_failed = self.__queries__(queries)
+        query_counts = bit_counts(queries)
+
+        hits = [
+            __search_block__(
+                queries, query_counts, self.fingerprints, self.counts, start, start + block_size, threshold, k,
+                block_size, query_failed=query_failed, library_failed=self.failed
+            )
+            for start in range(0, len(queries), block_size)
+        ]
+
+        return pd.DataFrame({
+            'query' : np.concatenate([h[0] for h in hits]) if hits else np.zeros(0, dtype=np.int64),
+            'id' : self.ids[np.concatenate([h[1] for h in hits])] if hits else self.ids[:0],
+            'similarity' : np.concatenate([h[2] for h in hits]) if hits else np.zeros(0, dtype=np.float32),
+        })
+
+    def all_pairs(self, threshold=.7, k=None, processes=None, block_size=1024):
+        """
+            Compares every library compound with every other one, e.g. to find duplicates or cluster the library.
+            Blocks of rows are spread over a process pool
+
+            Input
+            ----------------------------------------------------------------
+            threshold : float (default .7)
+                minimum Tanimoto similarity of a pair
+            k : int (default None)
+                keep the k nearest neighbors of every compound instead of every pair, ties with the k-th
+                neighbor are broken arbitrarily
+            processes : int (default None)
+                number of worker processes, defaults to the number of cores. 1 runs in the calling process
+            block_size : int (default 1024)
+                rows (and columns) compared at once
+
+            Returns
+            ----------------------------------------------------------------
+            pairs : pd.DataFrame
+                'id_1', 'id_2' and 'similarity' of every pair. Without k each pair appears once (id_1 before
+                id_2 in the library), with k every compound lists its neighbors as id_1
+        """
+        bounds = [(start, min(start + block_size, len(self))) for start in range(0, len(self), block_size)]
+        task = partial(__all_pairs_block__, threshold=threshold, k=k, block_size=block_size)
+
+        # Rows are processed in order of bit count, so the blocks of the library that can not reach the threshold
+        # of a row block are skipped (see __search_block__). Failed fingerprints are never paired
+        order = np.argsort(self.counts, kind='stable')
+        fingerprints, counts, failed = self.fingerprints[order], self.counts[order], self.failed[order]
+
+        if processes == 1:
+            __init_worker__(fingerprints, counts, failed)
+            results = [task(b) for b in bounds]
+        else:
+            with Pool(processes, initializer=__init_worker__, initargs=(fingerprints, counts, failed)) as pool:
+                results = pool.map(task, bounds)
+
+        if len(results) == 0:
+            return pd.DataFrame({'id_1' : self.ids[:0], 'id_2' : self.ids[:0], 'similarity' : np.zeros(0, dtype=np.float32)})
+
+        # Back to library positions, with the earlier compound of every pair first when all pairs are kept
+        qi = order[np.concatenate([r[0] for r in results])]
+        ci = order[np.concatenate([r[1] for r in results])]
+        if k is None:
+            qi, ci = np.minimum(qi, ci), np.maximum(qi, ci)
+
+        qi, ci, s = __top_k__(qi, ci, np.concatenate([r[2] for r in results]))
+
+        return pd.DataFrame({'id_1' : self.ids[qi], 'id_2' : self.ids[ci], 'similarity' : s})
@@ -0,0 +1,253 @@
+"""
+    Purpose: Shared http transport for the PubChem and NCBI apis, used by labeler and id_map
+
+    Requests go through one pooled keep-alive session and are paced per host, so that many lookups can be kept
+    in flight without going over the published request-per-second ceilings. PubChem allows no more than 5
+    requests per second (https://pubchemdocs.ncbi.nlm.nih.gov/programmatic-access) and the NCBI E-utilities
+    allow 3 requests per second without an api key (https://www.ncbi.nlm.nih.gov/books/NBK25497/)
+
+    Throttled (429), busy (503) and other server errors, timeouts and connection errors are retried a bounded
+    number of times with exponential backoff and jitter, honoring Retry-After. A host that keeps failing trips
+    a circuit breaker, and further requests to it fail immediately until a cooldown has passed
+
+    Primary Functions:
+        safe_urlopen: returns the content of a url, None if it does not exist
+        set_rate_limit: changes the request ceiling of a host
+"""
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Retry policy, can be changed at runtime (e.g. transport.MAX_RETRIES = 10)
+MAX_RETRIES = 5
+BACKOFF_BASE = .5 # seconds before the first retry
+BACKOFF_CAP = 30 # longest wait between retries, in seconds
+TIMEOUT = 30 # seconds before a request times out
+
+# Circuit breaker policy
+FAILURE_THRESHOLD = 5 # consecutive failed requests (after retries) before a host is considered down
+COOLDOWN = 60 # seconds before a request to a host that is down is tried again
+
+# Statuses that mean the term or id does not exist (or is not valid) in the database
+__MISSING_STATUSES__ = {400, 404}
+
+
+class TransportError(Exception):
+    """
+        Raised when a request still fails after all retries
+    """
+
+
+class CircuitOpenError(TransportError):
+    """
+        Raised without making a request while a host is considered down
+    """
+
+
+class RateLimiter:
+    """
+        Thread safe limiter that spaces calls evenly so that no more than rate calls are made per second
+
+        Input
+        ----------------------------------------------------------------
+        rate : float
+            maximum number of calls per second
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next_slot = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        # Reserve the next free slot while holding the lock, then sleep outside of it so other
+        # threads can reserve the slots after this one
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+__limiters__ = {
+    'pubchem.ncbi.nlm.nih.gov' : RateLimiter(5),
+    'eutils.ncbi.nlm.nih.gov' : RateLimiter(3),
+    'www.ncbi.nlm.nih.gov' : RateLimiter(3),
+}
+
+
+def set_rate_limit(host, rate):
+    """
+        Changes the request ceiling for a host, e.g. set_rate_limit('eutils.ncbi.nlm.nih.gov', 10) when
+        using an NCBI api key
+
+        Input
+        ----------------------------------------------------------------
+        host : str
+            host name of the api
+        rate : float
+            maximum number of requests per second
+    """
+    __limiters__[host] = RateLimiter(rate)
+
+
+class CircuitBreaker:
+    """
+        Tracks consecutive failures of a host. After failure_threshold failures the circuit opens and
+        requests fail fast. After cooldown seconds requests are let through again, and the first failure
+        re-opens the circuit
+    """
+    def __init__(self, failure_threshold=None, cooldown=None):
+        self.failure_threshold = FAILURE_THRESHOLD if failure_threshold is None else failure_threshold
+        self.cooldown = COOLDOWN if cooldown is None else cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # Half open, the next failure re-opens the circuit for another cooldown
+                self.opened_at = None
+                self.failures = self.failure_threshold - 1
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+__breakers__ = {}
+__breakers_lock__ = threading.Lock()
+
+
+def __breaker__(host):
+    with __breakers_lock__:
+        if host not in __breakers__:
+            __breakers__[host] = CircuitBreaker()
+        return __breakers__[host]
+
+
+def __make_session__():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=64)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Keep-alive session shared by all threads, so connections are reused between lookups
+__session__ = __make_session__()
+
+
+# Seconds to wait before retry number attempt (from 0). Uses Retry-After when the server sends it, otherwise
+# exponential backoff with full jitter
+def __retry_delay__(attempt, response=None):
+    retry_after = None if response is None else response.headers.get('Retry-After')
+
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), BACKOFF_CAP)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                return min(max(delay, 0), BACKOFF_CAP)
+            except (TypeError, ValueError):
+                pass
+
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def safe_urlopen(url, data=None):
+    """
+        Retrieves information from url query without throwing errors for values that do not exist, and
+        retries excessive querying and server errors. Designed for Pubchem and Pubmed apis
+
+        Input
+        ----------------------------------------------------------------
+        url : str
+            url to query
+        data : dict (default None)
+            form data to POST to the url, a GET request is made if None
+
+        Returns
+        ----------------------------------------------------------------
+        response.content : bytes or None
+            Returns the response of a url query if it exists, None if the api reports that it does not exist
+            (or that the query is not valid)
+
+        Raises
+        ----------------------------------------------------------------
+        TransportError
+            if the request still fails after MAX_RETRIES retries, CircuitOpenError if the host is down
+    """
+    host = urlparse(url).netloc
+    breaker = __breaker__(host)
+
+    if not breaker.allow():
+        raise CircuitOpenError(f'{host} is unavailable, not requesting {url}')
+
+    for attempt in range(MAX_RETRIES + 1):
+        throttle(url)
+
+        try:
+            if data is None:
+                response = __session__.get(url, timeout=TIMEOUT)
+            else:
+                response = __session__.post(url, data=data, timeout=TIMEOUT)
+        except (requests.Timeout, requests.ConnectionError, TimeoutError) as e:
+            response, error = None, e
+        else:
+            if response.status_code == 200: # Successful
+                breaker.record_success()
+                return response.content
+
+            if response.status_code in __MISSING_STATUSES__: # PUGREST.NotFound / BadRequest
+                breaker.record_success()
+                return None
+
+            error = f'status {response.status_code}'
+
+            # Any other client error will not change by retrying, but the host is up
+            if response.status_code < 500 and response.status_code != 429:
+                breaker.record_success()
+                raise TransportError(f'Request to {url} failed ({error})')
+
+        if attempt < MAX_RETRIES:
+            time.sleep(__retry_delay__(attempt, response))
+
+    breaker.record_failure()
+    raise TransportError(f'Request to {url} failed ({error})')
+
+
+def throttle(url):
+    """
+        Blocks until a request to url can be made without going over the ceiling of its host. Hosts
+        without a ceiling return immediately
+    """
+    limiter = __limiters__.get(urlparse(url).netloc)
+
+    if limiter is not None:
+        limiter.wait()